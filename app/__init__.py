@@ -1,6 +1,7 @@
 # python imports
 import os
 import logging
+import traceback
 from logging.handlers import RotatingFileHandler
 
 # installed imports
@@ -78,4 +79,14 @@ def create_app(config=Config):
     csrf.exempt(payment)
     csrf.exempt(meta_chabot)
 
+    # index the users' log folders before any request looks one up
+    from app.modules.userdirs import UserDirIndex
+
+    try:
+        index = UserDirIndex(config.USER_INDEX_DB, config.CHATLOG_DIR)
+        index.build()
+        index.close()
+    except:
+        logger.error(traceback.format_exc())
+
     return app
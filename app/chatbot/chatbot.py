@@ -1,6 +1,7 @@
 # python imports
 import os
 import traceback
+from typing import List
 
 # installed imports
 from dotenv import load_dotenv
@@ -8,6 +9,13 @@ from flask import Blueprint, request, jsonify, send_file, after_this_request
 
 # local imports
 from .. import logger
+from . import jobs
+from .events import WebhookEvent, coalesce
+from config import Config
+from ..modules.dedup import SeenIndex
+from ..modules.graph import graph_api
+from ..modules.dispatch import dispatcher
+from ..modules.timers import timers
 from .functions import *
 from ..modules.functions2 import record_message
 from ..modules.functions import *
@@ -22,7 +30,12 @@ load_dotenv()
 
 chatbot = Blueprint("chatbot", __name__)
 META_VERIFY_TOKEN = os.getenv("META_VERIFY_TOKEN")
+STATS_TOKEN = os.getenv("CHATBOT_STATS_TOKEN")
 BASE_COST = float(os.getenv("BASE_COST"))
+# message ids seen by any web process, to drop webhook redeliveries
+seen_messages = SeenIndex(
+    Config.QUEUE_DB, ttl=int(os.getenv("CHATBOT_DEDUP_TTL", 3600))
+)
 
 
 @chatbot.get("/send-voice-note")
@@ -61,111 +74,126 @@ def send_media():
     return "Not found", 404
 
 
+@chatbot.get("/meta-chatbot/stats")
+def stats():
+    if not STATS_TOKEN or request.args.get("token") != STATS_TOKEN:
+        return "Not found", 404
+    return jsonify(
+        queue=jobs.stats(),
+        graph_api=graph_api.stats(),
+        outbound=dispatcher.stats(),
+        timers=timers.stats(),
+        status_updates=status_pool.stats(),
+        tools=tool_registry.stats(),
+        summaries=summarizer.stats(),
+        memory=memory.stats(),
+        response_cache=response_cache.stats(),
+        message_dbs=engines.stats(),
+        user_dirs=user_dirs.stats(),
+        transcripts=transcripts.stats(),
+    )
+
+
 @chatbot.post("/meta-chatbot")
 def webhook():
     data = request.get_json()
     try:
-        # check for test account
-        if is_message(data):
-            if get_phone_id(data) == os.getenv("PHONE_NUMBER_ID"):
-                if not is_old(data):
-                    number = f"+{get_number(data)}"
-                    logger.info(number)
-                    name = get_name(data)
-                    message_id = get_message_id(data)
-                    message_type = get_message_type(data)
-                    mark_as_read(message_id)
-                    try:
-                        message = get_message(data)
-                    except KeyError:
-                        message = ""
-                    # try to get user
-                    user = User.query.filter(User.phone_no == number).one_or_none()
-                    if user:  # user account exists
-                        if user.phone_verified:
-                            if user.email_verified:
-                                # check user balance
-                                if not is_interative_reply(data):
-                                    if BASE_COST > user.balance:
-                                        text = f"Insufficent balance. Cost is {round(BASE_COST, 2)} BT.\nCurrent balance is {round(user.balance, 2)} BT"
-                                        logger.info(
-                                            f"INSUFFICIENT BALANCE - user: {user.phone_no}. BALANCE: {user.balance}"
-                                        )
-                                        header = "Recharge Now"
-                                        body = "Instantly top up your balance directly on WhatsApp"
-                                        button_texts = ["Yes", "No"]
-                                        button = generate_interactive_button(
-                                            header=header,
-                                            body=body,
-                                            button_texts=button_texts,
-                                        )
-                                        # record messages
-                                        record_message(
-                                            name=name,
-                                            number=number,
-                                            message=message,
-                                            assistant=False,
-                                        )
-                                        record_message(
-                                            name=name, number=number, message=text
-                                        )
-                                        send_text(text, number)
-                                        return send_interactive_message(
-                                            interactive=button, recipient=user.phone_no
-                                        )
+        # status updates make up most deliveries and carry no messages
+        events = WebhookEvent.parse(data)
+        # group messages by sender to keep each sender's messages in order
+        senders = {}
+        for event in events:
+            # check for test account
+            if event.phone_id != os.getenv("PHONE_NUMBER_ID") or is_old(event):
+                continue
+            if seen_messages.seen(event.message_id):
+                # redelivery of a message already being handled
+                logger.info(f"DUPLICATE MESSAGE: {event.message_id}")
+                continue
+            senders.setdefault(event.number, []).append(event)
+        for sender_events in senders.values():
+            sender_events.sort(key=lambda event: int(event.timestamp))
+            if not jobs.enabled():
+                handle_messages(sender_events)
+            else:
+                inline = jobs.enqueue(sender_events)
+                if inline:
+                    logger.warning(
+                        f"JOB QUEUE FULL ({jobs.depth()}). PROCESSING INLINE"
+                    )
+                    handle_messages(inline)
+    except:
+        logger.error(traceback.format_exc())
+    response = jsonify(success=True)
+    response.status_code = 200
+    return response
+
 
-                                    # charge base cost
-                                    user.balance -= BASE_COST
-                                    user.update()
-                                    logger.info(
-                                        f"DEDUCTED {BASE_COST} (BASE COST) FROM USER BALANCE IS {user.balance}"
-                                    )
-                                message_request = MessageRequest(user.id)
-                                message_request.interactive = (
-                                    True if is_interative_reply(data) else False
-                                )
-                                message_request.insert()
-                                if message_type == "audio":
-                                    # Audio response
-                                    meta_audio_response(
-                                        user=user,
-                                        data=data,
-                                        message_request=message_request,
-                                    )
-                                if message_type == "image":
-                                    # Image editing/variation
-                                    meta_image_response(
-                                        user=user,
-                                        data=data,
-                                        message_request=message_request,
-                                    )
-                                if message_type == "text":
-                                    # Chat/Dalle response
-                                    meta_chat_response(
-                                        user=user,
-                                        data=data,
-                                        message_request=message_request,
-                                    )
-                                if message_type == "interactive":
-                                    meta_interactive_response(
-                                        user=user,
-                                        data=data,
-                                        message_request=message_request,
-                                    )
-                            else:
-                                text = f"Please verify your email to access the service. Check your inbox for the verification link, or login to request another. {request.host_url}profile"
-                                record_message(
-                                    name=name,
-                                    number=number,
-                                    message=message,
-                                    assistant=False,
-                                )
-                                record_message(name=name, number=number, message=text)
-                                reply_to_message(
-                                    message_id, number, text
-                                ) if message_type == "text" else send_text(text, number)
-                        else:
-                            text = f"Please verify your number to access the service. Login to your profile to verify your number. {request.host_url}profile"
+def send_welcome(number: str) -> None:
+    """Send terms, features and sign up options to a first time user."""
+    text = f"Thank you for choosing BrainText 💙. We value your privacy and aim to provide the best service possible. In order to use our service, please review and agree to our Terms of Service {request.host_url}terms-of-service and Privacy Policy {request.host_url}privacy-policy. \nThese agreements outline how we collect, use, and protect your personal information. If you have any questions or concerns, please don't hesitate to contact us. \n\nThank you for your trust."
+    send_text(text, number)
+    # send list of features
+    with open(f"{TEMP_FOLDER}/features.txt") as f:
+        get_features = f.readlines()
+    features = "\n".join(get_features)
+    send_text(features, number)
+    # send option to sign up
+    body = f"Joining BrainText can enhance your experience by providing access to renewed prompts and features. Would you like to create an account now?"
+    header = "Register Now"
+    button_texts = ["Yes", "Maybe later"]
+    button = generate_interactive_button(
+        body=body, header=header, button_texts=button_texts
+    )
+    send_interactive_message(interactive=button, recipient=number)
+
+
+def handle_messages(events: List[WebhookEvent]) -> None:
+    """Process one sender's messages in order."""
+    if jobs.CHATBOT_COALESCE_MS:
+        events = coalesce(events)
+    for event in events:
+        handle_message(event)
+
+
+def handle_message(event: WebhookEvent, retry: bool = False) -> None:
+    """Process a single webhook message. Runs inline or on the worker pool.
+    \nWith `retry` (a queued job with attempts left) errors are raised for
+    the job to be retried, instead of answered with an apology, as long as
+    the user has not been charged for the message yet. A retry would charge
+    them again.
+    """
+    first_time = False
+    charged = False
+    try:
+        number = f"+{event.number}"
+        logger.info(number)
+        name = event.name
+        message_id = event.message_id
+        message_type = event.type
+        mark_as_read(message_id, wait=False)
+        message = event.body or ""
+        # try to get user
+        user = User.by_phone(number)
+        if user:  # user account exists
+            if user.phone_verified:
+                if user.email_verified:
+                    # check user balance
+                    if not is_interative_reply(event):
+                        if BASE_COST > user.balance:
+                            text = f"Insufficent balance. Cost is {round(BASE_COST, 2)} BT.\nCurrent balance is {round(user.balance, 2)} BT"
+                            logger.info(
+                                f"INSUFFICIENT BALANCE - user: {user.phone_no}. BALANCE: {user.balance}"
+                            )
+                            header = "Recharge Now"
+                            body = "Instantly top up your balance directly on WhatsApp"
+                            button_texts = ["Yes", "No"]
+                            button = generate_interactive_button(
+                                header=header,
+                                body=body,
+                                button_texts=button_texts,
+                            )
+                            # record messages
                             record_message(
                                 name=name,
                                 number=number,
@@ -173,97 +201,143 @@ def webhook():
                                 assistant=False,
                             )
                             record_message(name=name, number=number, message=text)
-                            reply_to_message(
-                                message_id, number, text
-                            ) if message_type == "text" else send_text(text, number)
-                    else:  # no account found
-                        # Anonymous user
-                        user = AnonymousUser.query.filter(
-                            AnonymousUser.phone_no == number
-                        ).one_or_none()
-                        if not user:
-                            user = AnonymousUser(phone_no=number)
-                            user.insert()
+                            send_text(text, number)
+                            return send_interactive_message(
+                                interactive=button, recipient=user.phone_no
+                            )
 
-                            # first time message. send tos and pp
-                            @after_this_request
-                            def first_time(response):
-                                text = f"Thank you for choosing BrainText 💙. We value your privacy and aim to provide the best service possible. In order to use our service, please review and agree to our Terms of Service {request.host_url}terms-of-service and Privacy Policy {request.host_url}privacy-policy. \nThese agreements outline how we collect, use, and protect your personal information. If you have any questions or concerns, please don't hesitate to contact us. \n\nThank you for your trust."
-                                send_text(text, number)
-                                # send list of features
-                                with open(f"{TEMP_FOLDER}/features.txt") as f:
-                                    get_features = f.readlines()
-                                features = "\n".join(get_features)
-                                send_text(features, number)
-                                # send option to sign up
-                                body = f"Joining BrainText can enhance your experience by providing access to renewed prompts and features. Would you like to create an account now?"
-                                header = "Register Now"
-                                button_texts = ["Yes", "Maybe later"]
-                                button = generate_interactive_button(
-                                    body=body, header=header, button_texts=button_texts
-                                )
-                                send_interactive_message(
-                                    interactive=button, recipient=number
-                                )
-                                return response
+                        # charge base cost
+                        charged = True
+                        user.balance -= BASE_COST
+                        user.update()
+                        logger.info(
+                            f"DEDUCTED {BASE_COST} (BASE COST) FROM USER BALANCE IS {user.balance}"
+                        )
+                    charged = True
+                    message_request = MessageRequest(user.id)
+                    message_request.interactive = (
+                        True if is_interative_reply(event) else False
+                    )
+                    message_request.insert()
+                    if message_type == "audio":
+                        # Audio response
+                        meta_audio_response(
+                            user=user,
+                            data=event,
+                            message_request=message_request,
+                        )
+                    if message_type == "image":
+                        # Image editing/variation
+                        meta_image_response(
+                            user=user,
+                            data=event,
+                            message_request=message_request,
+                        )
+                    if message_type == "text":
+                        # Chat/Dalle response
+                        meta_chat_response(
+                            user=user,
+                            data=event,
+                            message_request=message_request,
+                        )
+                    if message_type == "interactive":
+                        meta_interactive_response(
+                            user=user,
+                            data=event,
+                            message_request=message_request,
+                        )
+                else:
+                    text = f"Please verify your email to access the service. Check your inbox for the verification link, or login to request another. {request.host_url}profile"
+                    record_message(
+                        name=name,
+                        number=number,
+                        message=message,
+                        assistant=False,
+                    )
+                    record_message(name=name, number=number, message=text)
+                    reply_to_message(
+                        message_id, number, text
+                    ) if message_type == "text" else send_text(text, number)
+            else:
+                text = f"Please verify your number to access the service. Login to your profile to verify your number. {request.host_url}profile"
+                record_message(
+                    name=name,
+                    number=number,
+                    message=message,
+                    assistant=False,
+                )
+                record_message(name=name, number=number, message=text)
+                reply_to_message(
+                    message_id, number, text
+                ) if message_type == "text" else send_text(text, number)
+        else:  # no account found
+            # Anonymous user
+            user = AnonymousUser.by_phone(number)
+            if not user:
+                user = AnonymousUser(phone_no=number)
+                user.insert()
 
-                        signup = is_interative_reply(data)
-                        if signup or user.signup_stage != "anonymous":
-                            whatsapp_signup(
-                                data,
-                                user,
-                                interactive_reply=signup,
-                            )  # processing ends here as this sends a response to user
-                            signup = True
-                        if not signup and user.respond():
-                            # charge base cost
-                            user.balance -= BASE_COST
-                            user.update()
-                            logger.info(
-                                f"DEDUCTED {BASE_COST} (BASE COST) FROM USER BALANCE IS {user.balance}"
-                            )
-                            message_request = MessageRequest(user.id, True)
-                            message_request.insert()
-                            if message_type == "image":
-                                # Image editing/variation
-                                meta_image_response(
-                                    user=user,
-                                    data=data,
-                                    message_request=message_request,
-                                    anonymous=True,
-                                )
-                            if message_type == "text":
-                                # Chat/Dalle response
-                                meta_chat_response(
-                                    user=user,
-                                    data=data,
-                                    message_request=message_request,
-                                    anonymous=True,
-                                )
-                            elif message_type == "audio":
-                                # Audio response
-                                meta_audio_response(
-                                    user=user,
-                                    data=data,
-                                    message_request=message_request,
-                                    anonymous=True,
-                                )
-                        elif not signup and not user.respond():
-                            text = "Thank you for using our service. We're sorry to inform you that you have reached your limit of prompts. To continue receiving prompts, please consider signing up for an account at BrainText. Here, you can access more prompts and enhance your experience. Thank you for your understanding and support."
-                            reply_to_message(
-                                message_id, number, text
-                            ) if message_type == "text" else send_text(text, number)
-                            # send option to sign up
-                            body = "How would you like to register?"
-                            header = "Register to continue"
-                            button_texts = ["Our website", "Continue here"]
-                            button = generate_interactive_button(
-                                body=body, header=header, button_texts=button_texts
-                            )
-                            send_interactive_message(
-                                interactive=button, recipient=number
-                            )
+                # first time message. send tos and pp after processing
+                first_time = True
+
+            signup = is_interative_reply(event)
+            if signup or user.signup_stage != "anonymous":
+                whatsapp_signup(
+                    event,
+                    user,
+                    interactive_reply=signup,
+                )  # processing ends here as this sends a response to user
+                signup = True
+            if not signup and user.respond():
+                # charge base cost
+                charged = True
+                user.balance -= BASE_COST
+                user.update()
+                logger.info(
+                    f"DEDUCTED {BASE_COST} (BASE COST) FROM USER BALANCE IS {user.balance}"
+                )
+                message_request = MessageRequest(user.id, True)
+                message_request.insert()
+                if message_type == "image":
+                    # Image editing/variation
+                    meta_image_response(
+                        user=user,
+                        data=event,
+                        message_request=message_request,
+                        anonymous=True,
+                    )
+                if message_type == "text":
+                    # Chat/Dalle response
+                    meta_chat_response(
+                        user=user,
+                        data=event,
+                        message_request=message_request,
+                        anonymous=True,
+                    )
+                elif message_type == "audio":
+                    # Audio response
+                    meta_audio_response(
+                        user=user,
+                        data=event,
+                        message_request=message_request,
+                        anonymous=True,
+                    )
+            elif not signup and not user.respond():
+                text = "Thank you for using our service. We're sorry to inform you that you have reached your limit of prompts. To continue receiving prompts, please consider signing up for an account at BrainText. Here, you can access more prompts and enhance your experience. Thank you for your understanding and support."
+                reply_to_message(
+                    message_id, number, text
+                ) if message_type == "text" else send_text(text, number)
+                # send option to sign up
+                body = "How would you like to register?"
+                header = "Register to continue"
+                button_texts = ["Our website", "Continue here"]
+                button = generate_interactive_button(
+                    body=body, header=header, button_texts=button_texts
+                )
+                send_interactive_message(interactive=button, recipient=number)
     except:
+        if retry and not charged:
+            raise
         logger.error(traceback.format_exc())
         text = "Sorry, I can't respond to that at the moment. Plese try again later."
         record_message(name=name, number=number, message=message, assistant=False)
@@ -272,6 +346,5 @@ def webhook():
             message_id, number, text
         ) if message_type == "text" else send_text(text, number)
     finally:
-        response = jsonify(success=True)
-        response.status_code = 200
-        return response
+        if first_time:
+            send_welcome(number)
@@ -0,0 +1,134 @@
+# python imports
+from datetime import datetime
+from typing import Any, Dict, List, Union
+
+MEDIA_TYPES = ("image", "audio", "document", "video", "sticker")
+
+
+def _single_message(
+    payload: Dict[Any, Any],
+    entry: Dict[Any, Any],
+    change: Dict[Any, Any],
+    message: Dict[Any, Any],
+) -> Dict[Any, Any]:
+    """
+    Rebuild a webhook payload holding only `message` and its sender's contact.
+    This function is meant to be called internally
+    """
+    value = {
+        key: item
+        for key, item in change["value"].items()
+        if key not in ("messages", "contacts", "statuses")
+    }
+    value["messages"] = [message]
+    contacts = change["value"].get("contacts", [])
+    for contact in contacts:
+        if contact["wa_id"] == message.get("from"):
+            value["contacts"] = [contact]
+            break
+    else:
+        value["contacts"] = contacts[:1]
+    return {
+        "object": payload.get("object"),
+        "entry": [
+            {
+                "id": entry.get("id"),
+                "changes": [{"field": change.get("field"), "value": value}],
+            }
+        ],
+    }
+
+
+class WebhookEvent:
+    """A single WhatsApp webhook delivery, parsed once.
+    \nCarries everything the chatbot reads from the payload so the nested
+    dict is walked once per message instead of once per accessor call.
+    `payload` keeps the raw webhook dict for storage in the job queue.
+    \nMeta batches several messages and statuses into one delivery; use
+    `WebhookEvent.parse` to get one event per message.
+    """
+
+    __slots__ = (
+        "payload",
+        "phone_id",
+        "number",
+        "name",
+        "message_id",
+        "type",
+        "timestamp",
+        "body",
+        "media",
+        "context",
+        "interactive",
+        "status",
+    )
+
+    def __init__(self, payload: Dict[Any, Any]) -> None:
+        value = payload["entry"][0]["changes"][0]["value"]
+        message = value["messages"][0] if "messages" in value else None
+        contact = value["contacts"][0] if "contacts" in value else None
+        self.payload = payload
+        self.phone_id = (
+            value["metadata"]["phone_number_id"] if "metadata" in value else None
+        )
+        self.number = contact["wa_id"] if contact else None
+        self.name = contact["profile"]["name"] if contact else None
+        self.status = value["statuses"][0]["status"] if "statuses" in value else None
+        if message:
+            self.message_id = message["id"]
+            self.type = message["type"]
+            self.timestamp = message["timestamp"]
+            self.body = message["text"]["body"] if "text" in message else None
+            self.media = message.get(self.type) if self.type in MEDIA_TYPES else None
+            self.context = message.get("context")
+            self.interactive = message.get("interactive")
+        else:
+            self.message_id = None
+            self.type = None
+            self.timestamp = None
+            self.body = None
+            self.media = None
+            self.context = None
+            self.interactive = None
+
+    @classmethod
+    def parse(cls, payload: Dict[Any, Any]) -> List["WebhookEvent"]:
+        """One event for every message in every entry and change of `payload`.
+        \nStatus-only deliveries return an empty list. Each event's `payload`
+        is trimmed to its own message and sender.
+        """
+        events = []
+        for entry in payload.get("entry", []):
+            for change in entry.get("changes", []):
+                value = change.get("value", {})
+                for message in value.get("messages", []):
+                    events.append(cls(_single_message(payload, entry, change, message)))
+        return events
+
+    def is_message(self) -> bool:
+        return self.message_id is not None
+
+    def sent_at(self) -> Union[datetime, None]:
+        if self.timestamp:
+            return datetime.fromtimestamp(float(self.timestamp))
+
+    def __repr__(self) -> str:
+        return f"<WebhookEvent {self.type} {self.message_id} from {self.number}>"
+
+
+def coalesce(events: List[WebhookEvent]) -> List[WebhookEvent]:
+    """
+    Merge runs of consecutive text messages from one sender into one event.
+    The merged event keeps the id (and reply context) of the last message in
+    the run, and its body is the texts joined by newlines.
+    """
+    merged = []
+    for event in events:
+        previous = merged[-1] if merged else None
+        if previous and previous.type == "text" and event.type == "text":
+            combined = WebhookEvent(event.payload)
+            combined.body = f"{previous.body}\n{event.body}"
+            merged[-1] = combined
+        else:
+            merged.append(event)
+    return merged
@@ -1,7 +1,6 @@
 # python imports
 import re
 import os
-import requests
 import traceback
 from datetime import timedelta
 from typing import Any, Dict, Union, Literal
@@ -25,39 +24,38 @@ from ..modules.calculate import *
 from ..modules.functions2 import record_message
 from ..modules.email_utility import send_registration_email
 from ..modules.verification import generate_confirmation_token
+from .events import WebhookEvent
+from ..modules.graph import graph_api
+from ..modules.dispatch import dispatcher
+from ..modules.chunker import split_message, StreamChunker
 
 load_dotenv()
 
 USD2BT = int(os.getenv("USD2BT"))
 FILES = Config.FILES
 TEMP_FOLDER = Config.TEMP_FOLDER
-TOKEN = os.getenv("META_VERIFY_TOKEN")
-PHONE_NUMBER_ID = os.getenv("PHONE_NUMBER_ID")
-BASE_URL = "https://graph.facebook.com/v17.0"
-URL = f"{BASE_URL}/{PHONE_NUMBER_ID}/messages"
-HEADERS = {
-    "Content-Type": "application/json",
-    "Authorization": f"Bearer {TOKEN}",
-}
 
 
-def _preprocess(data: Dict[Any, Any]) -> Dict[Any, Any]:
+# accessors accept a parsed event or a raw webhook payload
+Payload = Union[WebhookEvent, Dict[Any, Any]]
+
+
+def _event(data: Payload) -> WebhookEvent:
     """
-    Preprocess incoming data from webhook.
+    Returns the parsed event for incoming data from webhook.
     This function is meant to be called internally
     """
-    return data["entry"][0]["changes"][0]["value"]
+    if isinstance(data, WebhookEvent):
+        return data
+    return WebhookEvent(data)
 
 
-def is_message(data: Dict[Any, Any]) -> bool:
+def is_message(data: Payload) -> bool:
     """
     Determines if incoming payload is from a message.
     Returns `bool`
     """
-    data = _preprocess(data)
-    if "messages" in data:
-        return True
-    return False
+    return _event(data).is_message()
 
 
 def is_valid_email(email):
@@ -71,27 +69,18 @@ def is_valid_email(email):
         return False
 
 
-def is_reply(data: Dict[Any, Any]) -> bool:
+def is_reply(data: Payload) -> bool:
     """
     Returns `True` if message is a reply, else returns `False`.
     """
-    data = _preprocess(data)
-    if "messages" in data:
-        if "context" in data["messages"][0]:
-            return True
-        return False
-    return False
+    return _event(data).context is not None
 
 
-def is_interative_reply(data: Dict[Any, Any]) -> bool:
+def is_interative_reply(data: Payload) -> bool:
     """
     Returns `True` if message is a reply to an interactive message, else returns `False`.
     """
-    is_reply = False
-    data = _preprocess(data)
-    if "interactive" in data["messages"][0]:
-        is_reply = True
-    return is_reply
+    return _event(data).interactive is not None
 
 
 def is_old(data):
@@ -105,91 +94,77 @@ def is_old(data):
     return True
 
 
-def get_phone_id(data: Dict[Any, Any]) -> Union[str, None]:
+def get_phone_id(data: Payload) -> Union[str, None]:
     """
     Extracts the WhatsApp phone number id of the recipeint.
     """
-    data = _preprocess(data)
-    if "metadata" in data:
-        return data["metadata"]["phone_number_id"]
+    return _event(data).phone_id
 
 
-def get_number(data: Dict[Any, Any]) -> Union[str, None]:
+def get_number(data: Payload) -> Union[str, None]:
     """
     Extracts the mobile number of the sender.
     """
-    data = _preprocess(data)
-    if "contacts" in data:
-        return data["contacts"][0]["wa_id"]
+    return _event(data).number
 
 
-def get_name(data: Dict[Any, Any]) -> Union[str, None]:
+def get_name(data: Payload) -> Union[str, None]:
     """
     Extracts the name of the sender.
     """
-    data = _preprocess(data)
-    if "contacts" in data:
-        return data["contacts"][0]["profile"]["name"]
+    return _event(data).name
 
 
-def get_message(data: Dict[Any, Any]) -> Union[str, None]:
+def get_message(data: Payload) -> Union[str, None]:
     """
     Extracts the message from the payload.
     """
-    data = _preprocess(data)
-    if "messages" in data:
-        return data["messages"][0]["text"]["body"]
+    return _event(data).body
 
 
-def get_timestamp(data: Dict[Any, Any]) -> datetime:
+def get_timestamp(data: Payload) -> datetime:
     """
     Extracts timestamp from message from message.
     """
-    data = _preprocess(data)
-    if "messages" in data:
-        return datetime.fromtimestamp(float(data["messages"][0]["timestamp"]))
+    return _event(data).sent_at()
 
 
-def get_message_id(data: Dict[Any, Any]) -> Union[str, None]:
+def get_message_id(data: Payload) -> Union[str, None]:
     """
     Extacts the message id from the payload.
     Zubbee is writing code.
     Osheyyyy
     """
-    data = _preprocess(data)
-    if "messages" in data:
-        return data["messages"][0]["id"]
+    return _event(data).message_id
 
 
-def get_message_timestamp(data: Dict[Any, Any]) -> Union[str, None]:
+def get_message_timestamp(data: Payload) -> Union[str, None]:
     """
     Extracts the timestamp of the message
     Zubbee again
     Peace out!
     """
-    data = _preprocess(data)
-    if "messages" in data:
-        return data["messages"][0]["timestamp"]
+    return _event(data).timestamp
 
 
-def mark_as_read(message_id: str) -> bool:
+def mark_as_read(message_id: str, wait: bool = True) -> bool:
     """
-    Mark a message as read.
+    Mark a message as read. Sent in the background with `wait=False`.
     """
     data = {
         "messaging_product": "whatsapp",
         "status": "read",
         "message_id": message_id,
     }
-    response = requests.post(
-        f"{BASE_URL}/{PHONE_NUMBER_ID}/messages", headers=HEADERS, json=data
-    )
-    if response.status_code == 200:
+    response = dispatcher.send(data, wait=wait, best_effort=True)
+    if response is not None and response.status_code == 200:
         return True
     return False
 
 
-def reply_to_message(message_id: str, recipient: str, message: str) -> Union[str, None]:
+def reply_to_message(
+    message_id: str, recipient: str, message: str, wait: bool = True
+) -> Union[str, None]:
     data = {
         "messaging_product": "whatsapp",
         "recipient_type": "individual",
@@ -198,14 +173,14 @@ def reply_to_message(message_id: str, recipient: str, message: str) -> Union[str
         "context": {"message_id": message_id},
         "text": {"preview_url": True, "body": message},
     }
-    response = requests.post(URL, headers=HEADERS, json=data)
-    if response.status_code == 200:
+    response = dispatcher.send(data, wait=wait)
+    if response is not None and response.status_code == 200:
         data = response.json()
         return str(data["messages"][0]["id"])
     return False
 
 
-def send_text(message: str, recipient: str) -> Union[str, None]:
+def send_text(message: str, recipient: str, wait: bool = True) -> Union[str, None]:
     data = {
         "messaging_product": "whatsapp",
         "recipient_type": "individual",
@@ -213,16 +188,17 @@ def send_text(message: str, recipient: str) -> Union[str, None]:
         "type": "text",
         "text": {"preview_url": True, "body": message},
     }
-    response = requests.post(URL, headers=HEADERS, json=data)
-    if response.status_code == 200:
+    response = dispatcher.send(data, wait=wait)
+    if response is not None and response.status_code == 200:
         data = response.json()
         return str(data["messages"][0]["id"])
     return None
 
 
-def send_reaction(emoji, message_id, recipient) -> bool:
+def send_reaction(emoji, message_id, recipient, wait: bool = True) -> bool:
     """
     Sends a reaction message to a WhatsApp user's message.
+    Sent in the background with `wait=False`.
 
     Args: `emoji`: Unicode value of emoji to be sent.
     """
@@ -233,13 +209,15 @@ def send_reaction(emoji, message_id, recipient) -> bool:
         "type": "reaction",
         "reaction": {"message_id": message_id, "emoji": emoji},
     }
-    response = requests.post(URL, headers=HEADERS, json=data)
-    if response.status_code == 200:
+    response = dispatcher.send(data, wait=wait, best_effort=True)
+    if response is not None and response.status_code == 200:
         return True
     return False
 
 
-def send_template(template: str, recipient: str, components: Any) -> bool:
+def send_template(
+    template: str, recipient: str, components: Any, wait: bool = True
+) -> bool:
     """
     Sends a template message with it's components.
     """
@@ -254,13 +232,15 @@ def send_template(template: str, recipient: str, components: Any) -> bool:
             "components": components,
         },
     }
-    response = requests.post(URL, headers=HEADERS, json=data)
-    if response.status_code == 200:
+    response = dispatcher.send(data, wait=wait)
+    if response is not None and response.status_code == 200:
         return True
     return False
 
 
-def send_image(image_link: str, recipient: str, caption=None) -> bool:
+def send_image(
+    image_link: str, recipient: str, caption=None, wait: bool = True
+) -> bool:
     """
     Sends an image with its link.
     """
@@ -271,13 +251,13 @@ def send_image(image_link: str, recipient: str, caption=None) -> bool:
         "type": "image",
         "image": {"link": image_link, "caption": caption},
     }
-    response = requests.post(URL, headers=HEADERS, json=data)
-    if response.status_code == 200:
+    response = dispatcher.send(data, wait=wait)
+    if response is not None and response.status_code == 200:
         return True
     return False
 
 
-def send_sticker(sticker_link: str, recipient: str) -> bool:
+def send_sticker(sticker_link: str, recipient: str, wait: bool = True) -> bool:
     """
     Sends a sticker to the user with its link.
     """
@@ -288,13 +268,13 @@ def send_sticker(sticker_link: str, recipient: str) -> bool:
         "type": "sticker",
         "sticker": {"link": sticker_link},
     }
-    response = requests.post(URL, headers=HEADERS, json=data)
-    if response.status_code == 200:
+    response = dispatcher.send(data, wait=wait)
+    if response is not None and response.status_code == 200:
         return True
     return False
 
 
-def send_audio(audio_link: str, recipient: str) -> bool:
+def send_audio(audio_link: str, recipient: str, wait: bool = True) -> bool:
     """
     Sends an audio message to the user with its link.
     """
@@ -304,13 +284,15 @@ def send_audio(audio_link: str, recipient: str) -> bool:
         "type": "audio",
         "audio": {"link": audio_link},
     }
-    response = requests.post(URL, headers=HEADERS, json=data)
-    if response.status_code == 200:
+    response = dispatcher.send(data, wait=wait)
+    if response is not None and response.status_code == 200:
         return True
     return False
 
 
-def send_video(video_link: str, recipient: str, caption=None) -> bool:
+def send_video(
+    video_link: str, recipient: str, caption=None, wait: bool = True
+) -> bool:
     """
     Sends a video to the user with its link.
     """
@@ -320,13 +302,15 @@ def send_video(video_link: str, recipient: str, caption=None) -> bool:
         "type": "video",
         "video": {"link": video_link, "caption": caption},
     }
-    response = requests.post(URL, headers=HEADERS, json=data)
-    if response.status_code == 200:
+    response = dispatcher.send(data, wait=wait)
+    if response is not None and response.status_code == 200:
         return True
     return False
 
 
-def send_document(document_link: str, recipient: str, caption=None) -> bool:
+def send_document(
+    document_link: str, recipient: str, caption=None, wait: bool = True
+) -> bool:
     """
     Sends a document to the user with its link.
     """
@@ -336,8 +320,8 @@ def send_document(document_link: str, recipient: str, caption=None) -> bool:
         "type": "document",
         "document": {"link": document_link, "caption": caption},
     }
-    response = requests.post(URL, headers=HEADERS, json=data)
-    if response.status_code == 200:
+    response = dispatcher.send(data, wait=wait)
+    if response is not None and response.status_code == 200:
         return True
     return False
 
@@ -363,6 +347,7 @@ def send_interactive_message(
     interactive: Dict[Any, Any],
     recipient: str,
     interactive_type: Literal["button", "list", "cta_url"] = "button",
+    wait: bool = True,
 ) -> Union[str, None]:
     """
     Sends an interactive message to the user.
@@ -375,8 +360,8 @@ def send_interactive_message(
         "type": "interactive",
         "interactive": _create_interaction(interactive, type=interactive_type),
     }
-    response = requests.post(URL, headers=HEADERS, json=data)
-    if response.status_code == 200:
+    response = dispatcher.send(data, wait=wait)
+    if response is not None and response.status_code == 200:
         data = response.json()
         return str(data["messages"][0]["id"])
     return None
@@ -386,7 +371,7 @@ def get_media_url(media_id: str) -> Union[str, None]:
     """
     Retrieves the url of media from the media id
     """
-    response = requests.get(f"{BASE_URL}/{media_id}", headers=HEADERS)
+    response = graph_api.get(media_id)
     if response.status_code == 200:
         return response.json()["url"]
     return None
@@ -398,7 +383,7 @@ def download_media(
     """
     Download media from media url and return its file path.
     """
-    response = requests.get(media_url, headers=HEADERS, timeout=5)
+    response = graph_api.get(media_url, timeout=30)
     if response.status_code == 200:
         try:
             full_path = os.path.join(file_path, file_name)
@@ -492,72 +477,61 @@ def generate_cta_action(
     return data
 
 
-def get_interactive_response(data: Dict[Any, Any]) -> Union[str, None]:
+def get_interactive_response(data: Payload) -> Union[str, None]:
     """
     Extracts the response of the interactive message from the payload.
     """
-    data = _preprocess(data)
-    if "messages" in data:
-        if "interactive" in data["messages"][0]:
-            return data["messages"][0]["interactive"]
+    return _event(data).interactive
 
 
-def get_image(data: Dict[Any, Any]) -> Union[Dict[Any, Any], None]:
+def _get_media(data: Payload, media_type: str):
+    event = _event(data)
+    if event.type == media_type:
+        return event.media
+
+
+def get_image(data: Payload) -> Union[Dict[Any, Any], None]:
     """
     Extracts the image id from the message payload.
     """
-    data = _preprocess(data)
-    if "messages" in data:
-        if "image" in data["messages"][0]:
-            return data["messages"][0]["image"]
+    return _get_media(data, "image")
 
 
-def get_document(data: Dict[Any, Any]) -> Union[Dict[Any, Any], None]:
+def get_document(data: Payload) -> Union[Dict[Any, Any], None]:
     """
     Extracts the document id from the message payload.
     """
-    data = _preprocess(data)
-    if "messages" in data:
-        if "document" in data["messages"][0]:
-            return data["messages"][0]["document"]
+    return _get_media(data, "document")
 
 
-def get_audio_id(data: Dict[Any, Any]) -> Union[str, None]:
+def get_audio_id(data: Payload) -> Union[str, None]:
     """
     Extracts the audio id from the message payload.
     """
-    data = _preprocess(data)
-    if "messages" in data:
-        if "audio" in data["messages"][0]:
-            return data["messages"][0]["audio"]["id"]
+    audio = _get_media(data, "audio")
+    if audio:
+        return audio["id"]
 
 
-def get_video(data: Dict[Any, Any]) -> Union[Dict[Any, Any], None]:
+def get_video(data: Payload) -> Union[Dict[Any, Any], None]:
     """
     Extracts the video id from the message payload.
     """
-    data = _preprocess(data)
-    if "messages" in data:
-        if "video" in data["messages"][0]:
-            return data["messages"][0]["video"]
+    return _get_media(data, "video")
 
 
-def get_message_type(data: Dict[Any, Any]) -> Union[str, None]:
+def get_message_type(data: Payload) -> Union[str, None]:
     """
     Gets the message type from the message payload.
     """
-    data = _preprocess(data)
-    if "messages" in data:
-        return data["messages"][0]["type"]
+    return _event(data).type
 
 
-def get_message_status(data: Dict[Any, Any]) -> Union[str, None]:
+def get_message_status(data: Payload) -> Union[str, None]:
     """
     Gets status of message from payload.
     """
-    data = _preprocess(data)
-    if "statuses" in data:
-        return data["statuses"][0]["status"]
+    return _event(data).status
 
 
 def send_otp_message(otp: int, number: str):
@@ -583,6 +557,7 @@ def send_otp_message(otp: int, number: str):
             template="phone_number_verification",
             recipient=number,
             components=components,
+            wait=True,
         )
         return success
     except:
@@ -598,36 +573,80 @@ def meta_split_and_respond(
     reply=False,
 ):
     """
-    Recursively split and send response to user.
+    Split a long response into chunks and send them in order.
+    Chunks are queued on the outbound dispatcher, so each one is in flight
+    while the next waits behind it. Only the first chunk is a reply.
     """
-    # If the text is shorter than the maximum length, process it directly
-    if len(text) <= max_length:
-        return (
-            send_text(text, number)
-            if not reply
-            else reply_to_message(prev_mssg_id, number, text)
-        )
-
-    # Otherwise, split the text into two parts and process each part recursively
-    middle_index = len(text) // 2
-
-    # Find the index of the nearest whitespace to the middle index
-    while middle_index < len(text) and not text[middle_index].isspace():
-        middle_index += 1
-
-    first_half = text[:middle_index]
-    second_half = text[middle_index:]
-
-    # Process the first half recursively
-    meta_split_and_respond(first_half, number, prev_mssg_id)
-
-    # Process the second half recursively
-    meta_split_and_respond(second_half, number, prev_mssg_id)
+    chunks = split_message(text, max_length)
+    result = (
+        reply_to_message(prev_mssg_id, number, chunks[0], wait=False)
+        if reply
+        else send_text(chunks[0], number, wait=False)
+    )
+    for chunk in chunks[1:]:
+        send_text(chunk, number, wait=False)
+    return result
+
+
+class StreamReply:
+    """Sends a ChatGPT answer to WhatsApp while it streams in.
+    \nPass an instance as `on_text` to `chatgpt_response`. Chunks are sent at
+    paragraph breaks; only the first one is a reply when `reply` is set.
+    """
+
+    def __init__(self, number: str, message_id: str = None, reply: bool = False):
+        self.number = number
+        self.message_id = message_id
+        self.reply = reply
+        self.chunker = StreamChunker(WHATSAPP_CHAR_LIMIT)
+        # text streamed in the current round
+        self.streamed = []
+        self.turn = 0
+        self.sent = 0
+
+    def __call__(self, text: str, turn: int = 0) -> None:
+        if turn != self.turn:
+            # the earlier round ended in tool calls, and only the last round
+            # is the answer
+            self.close()
+            self.streamed = []
+            self.turn = turn
+        self.streamed.append(text)
+        for chunk in self.chunker.feed(text):
+            self._send(chunk)
+
+    def close(self) -> None:
+        """Send what is left of the stream, for answers that end without
+        `finish` (a tool replied to the user, or an error).
+        """
+        for chunk in self.chunker.flush():
+            self._send(chunk)
+
+    def _send(self, chunk: str) -> None:
+        if self.reply and not self.sent:
+            reply_to_message(self.message_id, self.number, chunk, wait=False)
+        else:
+            send_text(chunk, self.number, wait=False)
+        self.sent += 1
+
+    def finish(self, text: str) -> bool:
+        """Send the rest of the stream. Returns `False` if `text` wasn't
+        streamed (streaming off, or an error message) and still has to be sent.
+        """
+        streamed = "".join(self.streamed)
+        if streamed and text and text.startswith(streamed):
+            # text after a tool call in the same round isn't streamed
+            for chunk in self.chunker.feed(text[len(streamed) :]):
+                self._send(chunk)
+            self.close()
+            return True
+        self.close()
+        return False
 
 
 def image_recognition(
     user: User,
-    data: Dict[Any, Any],
+    data: WebhookEvent,
     prompt: str,
     message_list: list,
     message_request: MessageRequest,
@@ -703,7 +722,7 @@ def image_recognition(
 
 
 def meta_chat_response(
-    data: Dict[Any, Any],
+    data: WebhookEvent,
     user: User,
     message_request: MessageRequest,
     message: str = None,
@@ -714,19 +733,20 @@ def meta_chat_response(
     """
     name = get_name(data)
     number = f"+{get_number(data)}"
-    user_db_path = get_user_db(name=name, number=number)
-    if not message:
-        message = get_message(data)
-    messages = load_messages(
-        user=user,
-        prompt=message,
-        db_path=user_db_path,
-    )
     message_id = get_message_id(data)
     isreply = is_reply(data)
-    greeting = contains_greeting(message)
-    thanks = contains_thanks(message)
+    stream = StreamReply(number, message_id, reply=isreply)
     try:
+        user_db_path = get_user_db(name=name, number=number)
+        if not message:
+            message = get_message(data)
+        messages = load_messages(
+            user=user,
+            prompt=message,
+            db_path=user_db_path,
+        )
+        greeting = contains_greeting(message)
+        thanks = contains_thanks(message)
         # check balance
         num_tokens = num_tokens_from_messages(messages)
         logger.info(f"INPUT TOKENS: {num_tokens}")
@@ -741,10 +761,14 @@ def meta_chat_response(
             return send_text(text, number)
         # react to message
         (
-            send_reaction(chr(128075), message_id, number) if greeting else None
+            send_reaction(chr(128075), message_id, number, wait=False)
+            if greeting
+            else None
         )  # react waving hand
         (
-            send_reaction(chr(128153), message_id, number) if thanks else None
+            send_reaction(chr(128153), message_id, number, wait=False)
+            if thanks
+            else None
         )  # react blue love emoji
 
         try:
@@ -756,9 +780,12 @@ def meta_chat_response(
                 number=number,
                 message_id=message_id,
                 message_request=message_request,
+                on_text=stream,
             )
             logger.info(f"CHATGPT RESPONSE: {response}")
             if not response:  # function called from ChatGPT response
+                # send the text streamed before the function call
+                stream.close()
                 return
             text, tokens, role = response[0], response[1], response[2]
             logger.info(f"CHATGPT RESPONSE TOKENS: {tokens[0], tokens[1]}")
@@ -778,6 +805,7 @@ def meta_chat_response(
             )
         except:
             logger.error(traceback.format_exc())
+            stream.close()
             text = (
                 "Sorry, I can't respond to that at the moment. Please try again later."
             )
@@ -796,11 +824,13 @@ def meta_chat_response(
         new_message.insert()
 
         if text:
+            if stream.finish(text):
+                return
             if len(text) < WHATSAPP_CHAR_LIMIT:
                 return (
-                    send_text(text, number)
+                    send_text(text, number, wait=False)
                     if not isreply
-                    else reply_to_message(message_id, number, text)
+                    else reply_to_message(message_id, number, text, wait=False)
                 )
             return (
                 meta_split_and_respond(text, number, message_id)
@@ -820,7 +850,7 @@ def meta_chat_response(
 
 def meta_audio_response(
     user: User,
-    data: Dict[Any, Any],
+    data: WebhookEvent,
     message_request: MessageRequest,
     anonymous: bool = False,
 ):
@@ -877,12 +907,17 @@ def meta_audio_response(
             delete_file(audio_file)
         # reactions
         (
-            send_reaction(chr(128075), message_id, number) if greeting else None
+            send_reaction(chr(128075), message_id, number, wait=False)
+            if greeting
+            else None
         )  # react waving hand
         (
-            send_reaction(chr(128153), message_id, number) if thanks else None
+            send_reaction(chr(128153), message_id, number, wait=False)
+            if thanks
+            else None
         )  # react blue love emoji
 
+        stream = None
         try:
             user_db_path = get_user_db(name, number)
             messages = load_messages(
@@ -904,6 +939,9 @@ def meta_audio_response(
                 )
                 record_message(name=name, number=number, message=text)
                 return send_text(text, number)
+            # voice answers are synthesized once complete, text answers stream
+            text_reply = not anonymous and not user.user_settings().audio_responses
+            stream = StreamReply(number) if text_reply else None
             response = chatgpt_response(
                 data=data,
                 user=user,
@@ -912,8 +950,12 @@ def meta_audio_response(
                 number=number,
                 message_id=message_id,
                 message_request=message_request,
+                on_text=stream,
             )
             if not response:  # function called from ChatGPT response
+                if stream:
+                    # send the text streamed before the function call
+                    stream.close()
                 return
             text, tokens, role = response[0], response[1], response[2]
             # update request records
@@ -932,6 +974,8 @@ def meta_audio_response(
             )
         except:
             logger.error(traceback.format_exc())
+            if stream:
+                stream.close()
             text = (
                 "Sorry I can't respond to that at the moment. Please try again later."
             )
@@ -941,6 +985,8 @@ def meta_audio_response(
         user_settings = user.user_settings() if not anonymous else None
         if user_settings:
             if not user_settings.audio_responses:
+                if stream.finish(text):
+                    return
                 if len(text) < WHATSAPP_CHAR_LIMIT:
                     return send_text(text, number)
                 else:
@@ -966,7 +1012,7 @@ def meta_audio_response(
 
 def meta_image_response(
     user: User,
-    data: Dict[Any, Any],
+    data: WebhookEvent,
     message_request: MessageRequest,
     anonymous: bool = False,
 ):
@@ -1027,7 +1073,7 @@ def meta_image_response(
 
 
 def meta_interactive_response(
-    data: Dict[Any, Any],
+    data: WebhookEvent,
     **kwargs,
 ):
     """WhatsApp interactive message response."""
@@ -1035,7 +1081,7 @@ def meta_interactive_response(
     logger.info(response)
     number = f"+{get_number(data)}"
     user: User
-    user = User.query.filter(User.phone_no == number).one_or_none()
+    user = User.by_phone(number)
     if not user:
         text = "Access to this feature requires an account. Please create an account to proceed."
         return send_text(text, number)
@@ -1590,7 +1636,7 @@ def meta_interactive_response(
 
 
 def whatsapp_signup(
-    data: Dict[Any, Any], user: AnonymousUser, interactive_reply: bool = False
+    data: WebhookEvent, user: AnonymousUser, interactive_reply: bool = False
 ):
     message_id = get_message_id(data)
     number = f"+{get_number(data)}"
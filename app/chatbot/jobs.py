@@ -0,0 +1,173 @@
+# python imports
+import os
+import time
+import traceback
+from typing import List
+
+# installed imports
+from dotenv import load_dotenv
+from flask import current_app, request
+
+# local imports
+from .. import logger
+from .events import WebhookEvent, coalesce
+from config import Config
+from ..modules.workers import LanePool, Debouncer
+from ..modules.jobstore import JobStore
+
+load_dotenv()
+
+# "memory" queues jobs on worker threads in the web process.
+# "sqlite" stores jobs in QUEUE_DB for `worker.py` to process.
+CHATBOT_QUEUE = os.getenv("CHATBOT_QUEUE", "memory")
+CHATBOT_WORKERS = int(os.getenv("CHATBOT_WORKERS", 0))
+CHATBOT_QUEUE_SIZE = int(os.getenv("CHATBOT_QUEUE_SIZE", 1000))
+CHATBOT_JOB_LEASE = int(os.getenv("CHATBOT_JOB_LEASE", 600))
+CHATBOT_JOB_ATTEMPTS = int(os.getenv("CHATBOT_JOB_ATTEMPTS", 3))
+# merge a sender's consecutive text messages arriving within this window
+CHATBOT_COALESCE_MS = int(os.getenv("CHATBOT_COALESCE_MS", 0))
+COALESCE_WINDOW = CHATBOT_COALESCE_MS / 1000
+
+store = (
+    JobStore(
+        Config.QUEUE_DB, lease=CHATBOT_JOB_LEASE, max_attempts=CHATBOT_JOB_ATTEMPTS
+    )
+    if CHATBOT_QUEUE == "sqlite"
+    else None
+)
+# no workers configured means webhooks are processed inline.
+# each sender gets a lane so their messages are handled in order.
+pool = (
+    LanePool("chatbot", workers=CHATBOT_WORKERS, maxsize=CHATBOT_QUEUE_SIZE)
+    if CHATBOT_WORKERS and not store
+    else None
+)
+
+
+def enabled() -> bool:
+    return bool(store or pool)
+
+
+class JobFailed(Exception):
+    """An event of a job failed and the job will be retried.
+    \n`remaining` holds the failed event and the ones after it, so the events
+    already answered are not processed again.
+    """
+
+    def __init__(self, remaining: List[WebhookEvent]) -> None:
+        super().__init__(f"{len(remaining)} events left")
+        self.remaining = remaining
+
+
+def run_in_context(
+    app, host_url: str, events: List[WebhookEvent], retry: bool = False
+) -> None:
+    """Process `events` in order, each inside a request context matching the
+    webhook's.
+    \nHandlers rely on `request.host_url` and `url_for` for links sent to users.
+    \nWith `retry`, a failing event raises `JobFailed` instead of sending the
+    user an apology, so the job can be tried again.
+    """
+    from .chatbot import handle_message
+
+    done = 0
+    for event in coalesce(events) if CHATBOT_COALESCE_MS else events:
+        try:
+            with app.test_request_context(base_url=host_url):
+                handle_message(event, retry=retry)
+        except Exception as error:
+            raise JobFailed(events[done:]) from error
+        # a merged event carries the id of the last message merged into it
+        while done < len(events):
+            done += 1
+            if events[done - 1].message_id == event.message_id:
+                break
+
+
+def enqueue(events: List[WebhookEvent]) -> List[WebhookEvent]:
+    """Queue one sender's `events` to be processed in order.
+    \nReturns the events the caller has to process inline, in order, because
+    the queue is full (empty if they were queued).
+    """
+    lane = events[0].number
+    # only text is held back to be merged with what follows
+    hold = bool(CHATBOT_COALESCE_MS) and all(event.type == "text" for event in events)
+    if store:
+        payloads = [event.payload for event in events]
+        store.put(
+            payloads,
+            host_url=request.host_url,
+            lane=lane,
+            kind="text" if hold else None,
+            delay=COALESCE_WINDOW if hold else 0,
+        )
+        return []
+    app = current_app._get_current_object()
+    if debouncer:
+        if pool.maxsize and pool.depth() >= pool.maxsize and not pool.busy(lane):
+            # the burst held back goes inline too, ahead of the new events
+            return debouncer.take(lane) + events
+        debouncer.add(lane, events, app, request.host_url, hold=hold)
+        return []
+    if pool.submit(lane, run_in_context, app, request.host_url, events):
+        return []
+    return events
+
+
+def submit_burst(lane, events: List[WebhookEvent], app, host_url: str) -> None:
+    """Queue a sender's collected burst once their coalescing window closes."""
+    # already acknowledged to Meta, so it can't be refused here
+    pool.push(lane, run_in_context, app, host_url, events)
+
+
+debouncer = (
+    Debouncer(COALESCE_WINDOW, submit_burst) if pool and CHATBOT_COALESCE_MS else None
+)
+
+
+def load_events(payload) -> List[WebhookEvent]:
+    """Events of a stored job. Jobs hold a list of single message payloads."""
+    if isinstance(payload, dict):
+        return WebhookEvent.parse(payload)
+    return [WebhookEvent(single) for single in payload]
+
+
+def depth() -> int:
+    return store.depth() if store else pool.depth()
+
+
+def drain(app, stop=None, poll_interval: float = 0.5) -> None:
+    """Process jobs from the job store until `stop` is set.
+    \nThis is the main loop of each `worker.py` process.
+    """
+    last_purge = 0
+    while not (stop and stop.is_set()):
+        job = store.claim()
+        if not job:
+            if time.time() - last_purge > 3600:
+                store.purge()
+                last_purge = time.time()
+            time.sleep(poll_interval)
+            continue
+        # the user is only told something went wrong on the last attempt
+        retry = job.attempts < store.max_attempts
+        try:
+            run_in_context(app, job.host_url, load_events(job.payload), retry=retry)
+            store.ack(job)
+        except JobFailed as failure:
+            logger.error(traceback.format_exc())
+            store.fail(job, [event.payload for event in failure.remaining])
+        except:
+            logger.error(traceback.format_exc())
+            store.fail(job)
+
+
+def stats() -> dict:
+    if store:
+        return {"mode": "sqlite", "depth": store.depth(), **store.stats()}
+    if pool:
+        stats = {"mode": "threads", **pool.stats()}
+        if debouncer:
+            stats["coalescing"] = debouncer.pending()
+        return stats
+    return {"mode": "inline"}
@@ -11,8 +11,9 @@ from datetime import datetime, timedelta, timezone
 import jwt
 import pytz
 import phonenumbers
-from flask import current_app
+from flask import current_app, g, has_app_context
 from dotenv import load_dotenv
+from sqlalchemy import inspect
 from flask_login import UserMixin
 from phonenumbers import timezone
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -67,12 +68,34 @@ class DatabaseHelperMixin(object):
         db.session.commit()
 
 
+# rows looked up by phone number while handling one request or queued message
+class PhoneLookupMixin(object):
+    @classmethod
+    def by_phone(cls, number: str):
+        """
+        The row with `phone_no == number`, or `None`.
+        Found rows are kept on `flask.g`, so one message queries each at most
+        once. Rows not found are looked up again, as they may be created.
+        """
+        lookups = g.setdefault("lookups", {}) if has_app_context() else {}
+        key = (cls.__name__, number)
+        row = lookups.get(key)
+        if row is not None:
+            state = inspect(row)
+            if not (state.was_deleted or state.detached):
+                return row
+        row = cls.query.filter(cls.phone_no == number).one_or_none()
+        if row is not None:
+            lookups[key] = row
+        return row
+
+
 @login_manager.user_loader
 def load_user(id):
     return User.query.get(int(id))
 
 
-class User(db.Model, TimestampMixin, UserMixin, DatabaseHelperMixin):
+class User(db.Model, TimestampMixin, UserMixin, DatabaseHelperMixin, PhoneLookupMixin):
     __tablename__ = "user"
 
     id = db.Column(db.Integer, primary_key=True)
@@ -89,6 +112,8 @@ class User(db.Model, TimestampMixin, UserMixin, DatabaseHelperMixin):
     from_anonymous = db.Column(db.Boolean, default=False)
     edited = db.Column(db.Boolean, default=False)
     password_hash = db.Column(db.String(128), nullable=False)
+    # loaded on first use and kept until the session commits
+    settings = db.relationship("UserSetting", uselist=False, lazy="select")
 
     def __init__(
         self, first_name, last_name, email, timezone_offset, password=None
@@ -133,7 +158,7 @@ class User(db.Model, TimestampMixin, UserMixin, DatabaseHelperMixin):
 
     def user_settings(self):
         settings: UserSetting
-        settings = UserSetting.query.filter(UserSetting.user_id == self.id).one()
+        settings = self.settings
         return settings
 
     # get local timezone
@@ -203,7 +228,7 @@ class UserSetting(db.Model, TimestampMixin, DatabaseHelperMixin):
         ]
 
 
-class AnonymousUser(db.Model, TimestampMixin, DatabaseHelperMixin):
+class AnonymousUser(db.Model, TimestampMixin, DatabaseHelperMixin, PhoneLookupMixin):
     __tablename__ = "anonymous_user"
 
     id = db.Column(db.Integer, primary_key=True)
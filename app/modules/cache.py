@@ -0,0 +1,67 @@
+# python imports
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable
+
+
+class LRUCache:
+    """Thread-safe cache holding at most `maxsize` entries.
+    \nThe least recently used entry is evicted first, and with a `ttl`
+    entries also expire that many seconds after they were set.
+    """
+
+    def __init__(self, maxsize: int, ttl: float = None) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0}
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._counters["misses"] += 1
+                return default
+            value, expires = entry
+            if expires is not None and expires < time.monotonic():
+                del self._entries[key]
+                self._counters["expired"] += 1
+                self._counters["misses"] += 1
+                return default
+            self._entries.move_to_end(key)
+            self._counters["hits"] += 1
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        if self.maxsize <= 0:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self._counters["evictions"] += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._counters["hits"] + self._counters["misses"]
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                **self._counters,
+                "hit_rate": (
+                    round(self._counters["hits"] / lookups, 3) if lookups else 0
+                ),
+            }
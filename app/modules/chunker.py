@@ -0,0 +1,111 @@
+# python imports
+from typing import List, Tuple
+
+FENCE = "```"
+# break points from most to least preferred. each is (separator, characters
+# of the separator kept at the end of the chunk)
+PARAGRAPH_BREAKS = (("\n\n", 0),)
+SENTENCE_BREAKS = ((". ", 1), ("! ", 1), ("? ", 1), (".\n", 1), ("\n", 0))
+WORD_BREAKS = ((" ", 0), ("\t", 0))
+
+
+def _find_break(text: str, start: int, end: int) -> Tuple[int, int]:
+    """
+    Where to split `text[start:end]`: the end of the chunk and the start of
+    the next one. Only break points in the second half of the window count,
+    so chunks stay close to the limit.
+    This function is meant to be called internally
+    """
+    floor = start + (end - start) // 2
+    for breaks in (PARAGRAPH_BREAKS, SENTENCE_BREAKS, WORD_BREAKS):
+        best = (-1, 0, 0)
+        for separator, kept in breaks:
+            index = text.rfind(separator, floor, end)
+            if index > best[0]:
+                best = (index, kept, len(separator))
+        index, kept, length = best
+        if index != -1:
+            return index + kept, index + length
+    return end, end
+
+
+def _take(text: str, start: int, limit: int, in_code: bool) -> Tuple[str, int, bool]:
+    """
+    Cut the next chunk of at most `limit` characters from `text[start:]`.
+    Returns the chunk, where the rest starts and whether the rest is inside a
+    code block.
+    This function is meant to be called internally
+    """
+    prefix = f"{FENCE}\n" if in_code else ""
+    # leave room to close a code block
+    end = start + limit - len(prefix) - len(FENCE) - 1
+    cut, next_start = _find_break(text, start, end)
+    chunk = text[start:cut]
+    if chunk.count(FENCE) % 2:
+        in_code = not in_code
+    return prefix + chunk + (f"\n{FENCE}" if in_code else ""), next_start, in_code
+
+
+def split_message(text: str, limit: int) -> List[str]:
+    """
+    Split `text` into ordered chunks of at most `limit` characters.
+    Chunks are packed greedily and broken on paragraph, then sentence, then
+    word boundaries. A code block split across chunks is closed at the end
+    of one chunk and reopened at the start of the next.
+    """
+    if len(text) <= limit:
+        return [text]
+    chunks = []
+    start = 0
+    in_code = False
+    while len(text) - start + (len(FENCE) + 1 if in_code else 0) > limit:
+        chunk, start, in_code = _take(text, start, limit, in_code)
+        chunks.append(chunk)
+    chunks.append((f"{FENCE}\n" if in_code else "") + text[start:])
+    return chunks
+
+
+class StreamChunker:
+    """Turns streamed text into messages as soon as they are ready.
+    \nA chunk is ready at a paragraph break once at least `min_length`
+    characters are waiting (outside a code block), or when `limit` is
+    reached. `flush` returns what is left when the stream ends.
+    """
+
+    def __init__(self, limit: int, min_length: int = 200) -> None:
+        self.limit = limit
+        self.min_length = min_length
+        self._text = ""
+        self._in_code = False
+
+    def feed(self, delta: str) -> List[str]:
+        """Add streamed text and return the chunks now ready to send."""
+        self._text += delta
+        ready = []
+        while True:
+            prefix = f"{FENCE}\n" if self._in_code else ""
+            if len(prefix) + len(self._text) > self.limit:
+                chunk, start, self._in_code = _take(
+                    self._text, 0, self.limit, self._in_code
+                )
+                self._text = self._text[start:]
+            else:
+                index = self._text.rfind("\n\n")
+                if (
+                    index < self.min_length
+                    or (self._in_code + self._text.count(FENCE, 0, index)) % 2
+                ):
+                    break
+                chunk = prefix + self._text[:index]
+                self._in_code = False
+                self._text = self._text[index + 2 :]
+            if chunk.strip():
+                ready.append(chunk)
+        return ready
+
+    def flush(self) -> List[str]:
+        """Return the rest of the text once the stream has ended."""
+        text = (f"{FENCE}\n" if self._in_code else "") + self._text
+        self._text = ""
+        self._in_code = False
+        return [text] if text.strip() else []
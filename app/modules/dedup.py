@@ -0,0 +1,72 @@
+# python imports
+import time
+import sqlite3
+import threading
+
+
+class SeenIndex:
+    """Bounded record of recently seen ids, shared through a SQLite file.
+    \nEvery process opening the same `path` sees the same ids, so gunicorn
+    workers agree on what has already been delivered. Entries expire after
+    `ttl` seconds and the table is capped at `max_entries` rows.
+    """
+
+    def __init__(self, path: str, ttl: int = 3600, max_entries: int = 100000) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._inserts = 0
+        self._connection().execute(
+            """
+            CREATE TABLE IF NOT EXISTS seen_messages (
+                message_id TEXT PRIMARY KEY,
+                seen_at REAL NOT NULL
+            )
+            """
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def seen(self, message_id: str) -> bool:
+        """Record `message_id` and return `True` if it was already recorded."""
+        conn = self._connection()
+        now = time.time()
+        # replace only entries that have expired
+        cursor = conn.execute(
+            """
+            INSERT INTO seen_messages (message_id, seen_at) VALUES (?, ?)
+            ON CONFLICT (message_id) DO UPDATE SET seen_at = excluded.seen_at
+            WHERE seen_messages.seen_at < ?
+            """,
+            (message_id, now, now - self.ttl),
+        )
+        if not cursor.rowcount:
+            return True
+        self._inserts += 1
+        if self._inserts % 1000 == 0:
+            self.evict()
+        return False
+
+    def evict(self) -> None:
+        """Drop expired entries and trim the table to `max_entries`."""
+        conn = self._connection()
+        conn.execute(
+            "DELETE FROM seen_messages WHERE seen_at < ?", (time.time() - self.ttl,)
+        )
+        conn.execute(
+            """
+            DELETE FROM seen_messages WHERE message_id IN (
+                SELECT message_id FROM seen_messages ORDER BY seen_at DESC
+                LIMIT -1 OFFSET ?
+            )
+            """,
+            (self.max_entries,),
+        )
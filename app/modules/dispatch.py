@@ -0,0 +1,163 @@
+# python imports
+import os
+import time
+import threading
+from concurrent.futures import Future
+from typing import Union
+
+# installed imports
+import requests
+from dotenv import load_dotenv
+
+# local imports
+from .. import logger
+from .workers import LanePool
+from .graph import GraphClient, PHONE_NUMBER_ID, graph_api
+
+load_dotenv()
+
+# threads delivering outbound messages (0 sends on the calling thread)
+GRAPH_SEND_WORKERS = int(os.getenv("GRAPH_SEND_WORKERS", 4))
+GRAPH_SEND_QUEUE_SIZE = int(os.getenv("GRAPH_SEND_QUEUE_SIZE", 1000))
+# messages per second per business phone number, for this process
+GRAPH_SEND_RATE = float(os.getenv("GRAPH_SEND_RATE", 80))
+
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens per second, up to `burst`."""
+
+    def __init__(self, rate: float, burst: float = None) -> None:
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """Take a token, sleeping until one is available.
+        \nReturns the seconds spent waiting.
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class Dispatcher:
+    """Delivers outbound WhatsApp messages in the background.
+    \nMessages to one recipient are sent one at a time in the order they were
+    queued, and every business phone number gets a token bucket so bursts
+    stay under Meta's throughput limit. When the queue is full the message
+    is sent on the calling thread instead.
+    \n`best_effort` sends (read receipts, reactions) are never retried and
+    are dropped rather than sent on the calling thread, so they can't hold
+    up a reply.
+    """
+
+    def __init__(
+        self,
+        client: GraphClient,
+        workers: int = GRAPH_SEND_WORKERS,
+        maxsize: int = GRAPH_SEND_QUEUE_SIZE,
+        rate: float = GRAPH_SEND_RATE,
+    ) -> None:
+        self.client = client
+        self.rate = rate
+        self.pool = (
+            LanePool("outbound", workers, maxsize=maxsize, tracked_lanes=100)
+            if workers
+            else None
+        )
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._throttled = 0.0
+        self._dropped = 0
+
+    def _bucket(self, phone_id: str) -> Union[TokenBucket, None]:
+        if not self.rate:
+            return None
+        with self._lock:
+            bucket = self._buckets.get(phone_id)
+            if not bucket:
+                bucket = self._buckets[phone_id] = TokenBucket(self.rate)
+            return bucket
+
+    def _deliver(
+        self, data: dict, phone_id: str, best_effort: bool = False
+    ) -> requests.Response:
+        bucket = self._bucket(phone_id)
+        if bucket:
+            waited = bucket.acquire()
+            if waited:
+                with self._lock:
+                    self._throttled += waited
+        retries = 0 if best_effort else None
+        return self.client.send(data, phone_id=phone_id, retries=retries)
+
+    def _run(
+        self, data: dict, phone_id: str, best_effort: bool, future: Future = None
+    ) -> None:
+        if not future:
+            # failures are logged by the pool
+            self._deliver(data, phone_id, best_effort)
+            return
+        try:
+            future.set_result(self._deliver(data, phone_id, best_effort))
+        except Exception as e:
+            future.set_exception(e)
+
+    def send(
+        self,
+        data: dict,
+        wait: bool = False,
+        phone_id: str = PHONE_NUMBER_ID,
+        best_effort: bool = False,
+    ) -> Union[requests.Response, None]:
+        """Queue `data` for the messages endpoint of `phone_id`.
+        \nWith `wait=True` this blocks until it is sent and returns the
+        response; otherwise it returns `None` straight away.
+        """
+        if not self.pool:
+            return self._deliver(data, phone_id, best_effort)
+        future = Future() if wait else None
+        # read receipts have no recipient
+        key = data.get("to") or data.get("message_id")
+        if best_effort:
+            # don't hold up replies in the recipient's lane
+            key = f"{key}:best_effort"
+        if not self.pool.submit(key, self._run, data, phone_id, best_effort, future):
+            if best_effort and not wait:
+                with self._lock:
+                    self._dropped += 1
+                return None
+            logger.warning(f"OUTBOUND QUEUE FULL ({self.pool.depth()}). SENDING NOW")
+            return self._deliver(data, phone_id, best_effort)
+        if future:
+            return future.result()
+        return None
+
+    def join(self, timeout: float = None) -> bool:
+        """Wait for queued messages to be sent. Returns `False` on timeout."""
+        return self.pool.join(timeout) if self.pool else True
+
+    def stats(self) -> dict:
+        stats = {"mode": "threads" if self.pool else "inline", "rate": self.rate}
+        if self.pool:
+            stats.update(self.pool.stats())
+        with self._lock:
+            stats["throttled"] = round(self._throttled, 3)
+            stats["dropped"] = self._dropped
+        return stats
+
+
+dispatcher = Dispatcher(graph_api)
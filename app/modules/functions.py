@@ -6,28 +6,44 @@ import base64
 import tempfile
 import requests
 import tempfile
-import traceback
+import time
 import threading
+import traceback
 import subprocess
 from bs4 import BeautifulSoup
 from datetime import datetime
 from bs4 import BeautifulSoup
 from contextlib import closing
-from typing import Union, Dict, Any
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Union, Dict, Any, Callable
 
 # installed imports
 import langid
-import tiktoken
 import pycountry
 import pytesseract
 from PIL import Image
 from boto3 import Session
 from openai import OpenAI
+from openai.types.chat import ChatCompletion
+from openai.types.completion_usage import CompletionUsage
+from openai.types.chat.chat_completion import Choice
+from openai.types.chat.chat_completion_message import ChatCompletionMessage
+from openai.types.chat.chat_completion_message_tool_call import (
+    ChatCompletionMessageToolCall,
+    Function,
+)
 from sqlalchemy import desc
 from pydub import AudioSegment
 from datetime import timedelta
 from dotenv import load_dotenv
-from flask import url_for, request
+from flask import (
+    url_for,
+    request,
+    current_app,
+    has_app_context,
+    has_request_context,
+    copy_current_request_context,
+)
 from google.oauth2 import service_account
 from google.cloud import texttospeech, storage
 from google.cloud.speech_v2 import SpeechClient
@@ -38,9 +54,27 @@ from botocore.exceptions import BotoCoreError, ClientError
 from .. import logger
 from config import Config
 from ..modules.calculate import *
-from ..payment.routes import BANK_CODES
 from ..models import Voice, User, AnonymousUser, MessageRequest
-from ..modules.messages import create_all, get_engine, Messages
+from ..modules.messages import (
+    engines,
+    schedule_purge,
+    CONVERSATION_STORE,
+    get_engine,
+    get_encoding,
+    message_tokens,
+    Messages,
+)
+from ..chatbot.events import WebhookEvent
+from .dispatch import dispatcher
+from .timers import timers
+from .workers import WorkerPool
+from .tools import ToolRegistry
+from .userdirs import UserDirIndex, hashed_dir, merge_dir
+from .transcripts import TranscriptWriter
+from .summary import Summarizer
+from .cache import LRUCache
+from .memory import Memory, CHATGPT_MEMORY_PROVIDER, CHATGPT_MEMORY_DIM
+from .vectors import HashingEmbeddings, OpenAIEmbeddings
 
 # chatgpt functions
 from .functions2 import account_settings, record_message
@@ -52,19 +86,17 @@ load_dotenv()
 USD2BT = int(os.getenv("USD2BT"))
 CHATLOG_DIR = Config.CHATLOG_DIR
 TEMP_FOLDER = Config.TEMP_FOLDER
+user_dirs = UserDirIndex(Config.USER_INDEX_DB, CHATLOG_DIR)
+# "name" shards user folders by display name, "hashed" by a hash of the number
+CHATLOG_LAYOUT = os.getenv("CHATLOG_LAYOUT", "name")
+# seconds transcript lines are buffered before being written (0 writes inline)
+TRANSCRIPT_FLUSH_INTERVAL = float(os.getenv("TRANSCRIPT_FLUSH_INTERVAL", 0))
+TRANSCRIPT_FLUSH_LINES = int(os.getenv("TRANSCRIPT_FLUSH_LINES", 200))
+TRANSCRIPT_OPEN_FILES = int(os.getenv("TRANSCRIPT_OPEN_FILES", 128))
 WHATSAPP_NUMBER = os.getenv("WHATSAPP_NUMBER")
 WHATSAPP_TEMPLATE_NAMESPACE = os.getenv("WHATSAPP_TEMPLATE_NAMESPACE")
 WHATSAPP_TEMPLATE_NAME = os.getenv("WHATSAPP_TEMPLATE_NAME")
 WHATSAPP_CHAR_LIMIT = int(os.getenv("WHATSAPP_CHAR_LIMIT"))
-# Meta
-TOKEN = os.getenv("META_VERIFY_TOKEN")
-PHONE_NUMBER_ID = os.getenv("PHONE_NUMBER_ID")
-BASE_URL = "https://graph.facebook.com/v17.0"
-URL = f"{BASE_URL}/{PHONE_NUMBER_ID}/messages"
-HEADERS = {
-    "Content-Type": "application/json",
-    "Authorization": f"Bearer {TOKEN}",
-}
 # gcloud
 GOOGLE_APPLICATION_CREDENTIALS = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
 GOOGLE_CREDENTIALS = service_account.Credentials.from_service_account_file(
@@ -73,9 +105,41 @@ GOOGLE_CREDENTIALS = service_account.Credentials.from_service_account_file(
 
 # openai
 openai_client = OpenAI()
+summarizer = Summarizer(openai_client)
+memory = Memory(
+    HashingEmbeddings(CHATGPT_MEMORY_DIM)
+    if CHATGPT_MEMORY_PROVIDER == "hashing"
+    else OpenAIEmbeddings(openai_client, dim=CHATGPT_MEMORY_DIM)
+)
+# send ChatGPT responses to WhatsApp while they are being generated
+CHATGPT_STREAM = bool(int(os.getenv("CHATGPT_STREAM", 0)))
+# completions that may call tools before ChatGPT has to answer in text
+CHATGPT_TOOL_ROUNDS = int(os.getenv("CHATGPT_TOOL_ROUNDS", 3))
+# threads running the tools ChatGPT asks for in one turn, shared by all requests
+CHATGPT_TOOL_WORKERS = int(os.getenv("CHATGPT_TOOL_WORKERS", 8))
+# seconds a tool may take, unless it sets its own `timeout`
+CHATGPT_TOOL_TIMEOUT = float(os.getenv("CHATGPT_TOOL_TIMEOUT", 30))
+# tool calls running or waiting for a thread, further calls fail straight away
+CHATGPT_TOOL_QUEUE_SIZE = int(os.getenv("CHATGPT_TOOL_QUEUE_SIZE", 100))
+tool_pool = ThreadPoolExecutor(
+    max_workers=CHATGPT_TOOL_WORKERS, thread_name_prefix="tools"
+)
+tool_slots = threading.BoundedSemaphore(CHATGPT_TOOL_QUEUE_SIZE)
+# "still thinking" messages, sent off the timers thread
+status_pool = WorkerPool("status", 2, maxsize=100)
+# answers to standalone prompts kept for reuse (0 disables)
+CHATGPT_CACHE_SIZE = int(os.getenv("CHATGPT_CACHE_SIZE", 0))
+CHATGPT_CACHE_TTL = int(os.getenv("CHATGPT_CACHE_TTL", 6 * 3600))
+response_cache = LRUCache(CHATGPT_CACHE_SIZE, CHATGPT_CACHE_TTL)
+# prompts that refer to the conversation or change over time
+CONTEXT_PATTERN = re.compile(
+    r"\b(it|its|that|this|these|those|them|they|he|she|him|her|above|previous"
+    r"|earlier|again|more|continue|same|last|you said|today|now|time"
+    r"|date|tomorrow|yesterday|weather|news|latest|current)\b"
+)
 
 
-def send_text(message: str, recipient: str) -> Union[str, None]:
+def send_text(message: str, recipient: str, wait: bool = True) -> Union[str, None]:
     data = {
         "messaging_product": "whatsapp",
         "recipient_type": "individual",
@@ -83,14 +147,16 @@ def send_text(message: str, recipient: str) -> Union[str, None]:
         "type": "text",
         "text": {"preview_url": True, "body": message},
     }
-    response = requests.post(URL, headers=HEADERS, json=data)
-    if response.status_code == 200:
+    response = dispatcher.send(data, wait=wait)
+    if response is not None and response.status_code == 200:
         data = response.json()
         return str(data["messages"][0]["id"])
     return None
 
 
-def reply_to_message(message_id: str, recipient: str, message: str) -> Union[str, None]:
+def reply_to_message(
+    message_id: str, recipient: str, message: str, wait: bool = True
+) -> Union[str, None]:
     data = {
         "messaging_product": "whatsapp",
         "recipient_type": "individual",
@@ -99,8 +165,8 @@ def reply_to_message(message_id: str, recipient: str, message: str) -> Union[str
         "context": {"message_id": message_id},
         "text": {"preview_url": True, "body": message},
     }
-    response = requests.post(URL, headers=HEADERS, json=data)
-    if response.status_code == 200:
+    response = dispatcher.send(data, wait=wait)
+    if response is not None and response.status_code == 200:
         data = response.json()
         return str(data["messages"][0]["id"])
     return False
@@ -176,13 +242,22 @@ def image_to_string(image_path: str):
         return None
 
 
-def log_location(name: str, number: str) -> str:
+def log_location(name: str, number: str, when: datetime = None) -> str:
     """Create directory matching first letter of display name.
     \nTo organise logs in alphabetical order.
     \nExample log directory `logs/chatbot/AAA/display_name/<date>`
     \nReturns the log directory to store based on name passed in.
     \nCreates it if it doesn't exist.
+    \nThe log is that of the day of `when` (default now, UTC).
     """
+    when = when or datetime.utcnow()
+    if CHATLOG_LAYOUT == "hashed":
+        month_log = os.path.join(
+            hashed_user_dir(number, create=True),
+            f"{when.strftime('%m-%Y')}",
+        )
+        os.makedirs(month_log, exist_ok=True)
+        return f"{month_log}/{when.strftime('%d-%m-%Y')}.log"
     first_char = str(name[0]).upper()
     if first_char.isalpha():  # first character is a letter
         directory = f"{CHATLOG_DIR}/{first_char}{first_char}{first_char}"
@@ -191,12 +266,11 @@ def log_location(name: str, number: str) -> str:
         user_directory = f"{directory}/{name.replace(' ', '_').strip()}_{number}"
         if not os.path.exists(user_directory):
             os.mkdir(user_directory)
-        month_log = os.path.join(
-            user_directory, f"{datetime.utcnow().strftime('%m-%Y')}"
-        )
+        user_dirs.register(number, user_directory)
+        month_log = os.path.join(user_directory, f"{when.strftime('%m-%Y')}")
         if not os.path.exists(month_log):
             os.mkdir(month_log)
-        day_log = f"{month_log}/{datetime.utcnow().strftime('%d-%m-%Y')}.log"
+        day_log = f"{month_log}/{when.strftime('%d-%m-%Y')}.log"
         return day_log
 
     else:  # first character is not a letter
@@ -206,15 +280,22 @@ def log_location(name: str, number: str) -> str:
         user_directory = f"{directory}/{name.replace(' ', '_').strip()}_{number}"
         if not os.path.exists(user_directory):
             os.mkdir(user_directory)
-        month_log = os.path.join(
-            user_directory, f"{datetime.utcnow().strftime('%m-%Y')}"
-        )
+        user_dirs.register(number, user_directory)
+        month_log = os.path.join(user_directory, f"{when.strftime('%m-%Y')}")
         if not os.path.exists(month_log):
             os.mkdir(month_log)
-        day_log = f"{month_log}/{datetime.utcnow().strftime('%d-%m-%Y')}.log"
+        day_log = f"{month_log}/{when.strftime('%d-%m-%Y')}.log"
         return day_log
 
 
+transcripts = TranscriptWriter(
+    log_location,
+    interval=TRANSCRIPT_FLUSH_INTERVAL,
+    max_lines=TRANSCRIPT_FLUSH_LINES,
+    open_files=TRANSCRIPT_OPEN_FILES,
+)
+
+
 def edit_image(image_path: str, prompt: str) -> str:
     """Edit's a picture with a second picture acting as a mask."""
     image = open(image_path, "rb")
@@ -245,12 +326,11 @@ def create_image_variation(image_path: str) -> str:
 
 
 def log_response(name: str, number: str, message: str, tokens: tuple = 0) -> None:
-    with open(log_location(name, number), "a") as file:
-        message = message.replace("\n", " ")
-        print(
-            f"{message} ({tokens}) -- {str(datetime.utcnow().strftime('%H:%M'))}",
-            file=file,
-        )
+    when = datetime.utcnow()
+    message = message.replace("\n", " ")
+    transcripts.write(
+        name, number, when, f"{message} ({tokens}) -- {when.strftime('%H:%M')}\n"
+    )
 
 
 def get_audio(audio_url: str, file_name: str) -> None:
@@ -274,10 +354,35 @@ def delete_file(filename: str) -> None:
         os.remove(filename)
 
 
+def hashed_user_dir(number: str, create: bool = False) -> Union[str, None]:
+    """
+    The user's folder in the hashed layout, `None` if there is none.
+    \nA lookup only resolves the path, so a folder of the name-based layout
+    is returned where it is. With `create` it is moved to the hashed layout.
+    This function is meant to be called internally
+    """
+    log_path = hashed_dir(CHATLOG_DIR, number)
+    if os.path.isdir(log_path):
+        return log_path
+    old_path = user_dirs.get(number)
+    if not create:
+        return old_path
+    if old_path and old_path != log_path:
+        engines.forget(os.path.join(old_path, "messages.db"))
+        merge_dir(old_path, log_path)
+    else:
+        os.makedirs(log_path, exist_ok=True)
+    user_dirs.register(number, log_path)
+    return log_path
+
+
 def user_dir(number: str, name: str = None) -> str:
     """Returns the user's folder"""
     try:
-        if name:
+        if CHATLOG_LAYOUT == "hashed":
+            # the name plays no part in where the folder is
+            log_path = hashed_user_dir(number, create=bool(name))
+        elif name:
             # get user folder with name and number
             first_char = str(name[0]).upper()
             if first_char.isalpha():
@@ -294,18 +399,10 @@ def user_dir(number: str, name: str = None) -> str:
                 )
             if not os.path.exists(log_path):
                 os.makedirs(log_path, exist_ok=True)
+            user_dirs.register(number, log_path)
         else:
-            # get newest folder in log dir with number
-            log_path = None
-            newest_timestamp = 0
-            for root, dirs, _ in os.walk(CHATLOG_DIR):
-                for dir_name in dirs:
-                    if number in dir_name:
-                        dir_path = os.path.join(root, dir_name)
-                        timestamp = os.path.getctime(dir_path)
-                        if timestamp > newest_timestamp:
-                            newest_timestamp = timestamp
-                            log_path = dir_path
+            # newest folder with number, see `UserDirIndex`
+            log_path = user_dirs.get(number)
         return log_path
 
     except:
@@ -324,12 +421,20 @@ def are_same_day(datetime_obj1, datetime_obj2):
 def get_user_db(name: str, number: str) -> str:
     """Returns the current user's message database"""
     db_path = os.path.join(user_dir(name=name, number=number), "messages.db")
-    if os.path.exists(db_path):
+    if CONVERSATION_STORE == "sqlite":
+        # the shared database is not wiped, old rows are purged instead
+        schedule_purge()
+    elif os.path.exists(db_path):
         dp_mtime = datetime.fromtimestamp(os.path.getmtime(db_path))
-        if not are_same_day(dp_mtime, datetime.utcnow()):
+        # a summary being written still uses the database, wipe it next time
+        if not are_same_day(dp_mtime, datetime.utcnow()) and not summarizer.busy(
+            db_path
+        ):
             # delete database
+            engines.forget(db_path)
             os.remove(db_path)
-    create_all(get_engine(db_path))
+    # opens the database and creates its tables once per process
+    get_engine(db_path)
     return db_path
 
 
@@ -343,7 +448,7 @@ def get_last_message_time(user_dir: str) -> datetime | None:
         for root, _, files in os.walk(user_dir):
             for file in files:
                 file_path = os.path.join(root, file)
-                if not file_path.endswith(".db"):
+                if file_path.endswith(".log"):
                     file_timestamp = os.path.getctime(file_path)
                     if file_timestamp > newest_timestamp:
                         newest_timestamp = file_timestamp
@@ -374,6 +479,33 @@ def get_last_message_time(user_dir: str) -> datetime | None:
         return None
 
 
+def charge_summary(user: User) -> Union[Callable, None]:
+    """
+    A callback charging `user` for the summary of their conversation, which
+    is written on the summarizer's thread once the request is over.
+    This function is meant to be called internally
+    """
+    if not isinstance(user, (User, AnonymousUser)) or not has_app_context():
+        return None
+    app = current_app._get_current_object()
+    model, user_id = type(user), user.id
+
+    def charge(usage: CompletionUsage) -> None:
+        cost = gpt_3_5_cost(
+            {"input": usage.prompt_tokens, "output": usage.completion_tokens}
+        )
+        bt_cost = cost * USD2BT
+        with app.app_context():
+            user = model.query.get(user_id)
+            user.balance -= bt_cost
+            user.update()
+            logger.info(
+                f"DEDUCTED {bt_cost} FROM USER #{user_id} ChatGPT summary. BALANCE IS {user.balance}"
+            )
+
+    return charge
+
+
 def load_messages(
     user: User,
     db_path: str,
@@ -394,19 +526,56 @@ def load_messages(
         context_limit = int(user.user_settings().context_messages) or 1
     else:
         context_limit = 10
-    get_messages = (
-        session.query(Messages).order_by(desc(Messages.id)).limit(context_limit).all()
+    # older messages are sent as their summary
+    summary = summarizer.latest(session, db_path)
+    query = Messages.query_for(session, db_path)
+    if summary:
+        query = query.filter(Messages.id > summary.last_message_id)
+    get_messages = list(
+        reversed(query.order_by(desc(Messages.id)).limit(context_limit).all())
     )
-    messages = [
-        {"role": message.role, "content": message.content if message.content else ""}
-        for message in reversed(get_messages)
-    ]
+    messages = [message.as_dict() for message in get_messages]
 
     if message_list:
         messages.append(message_list[0])
     else:
-        while num_tokens_from_messages(messages) > 16000:
-            messages.pop(0)
+        # count messages stored before token counts were
+        uncounted = [row for row in get_messages if row.tokens is None]
+        for row in uncounted:
+            row.tokens = message_tokens(row.as_dict())
+        if uncounted:
+            session.commit()
+        # earlier messages relevant to the prompt
+        recalled = memory.recall(
+            os.path.dirname(db_path),
+            prompt,
+            exclude=[message["content"] for message in messages],
+        )
+        if recalled:
+            recalled = {
+                "role": "system",
+                "content": "Earlier messages that may be relevant:\n"
+                + "\n".join(
+                    f"{message['role']}: {message['content']}" for message in recalled
+                ),
+            }
+        # drop the oldest messages until the rest fit
+        num_tokens = sum(row.tokens for row in get_messages) + 3
+        if summary:
+            num_tokens += summary.tokens
+        if recalled:
+            num_tokens += message_tokens(recalled)
+        start = 0
+        while num_tokens > 16000 and start < len(get_messages):
+            num_tokens -= get_messages[start].tokens
+            start += 1
+        messages = messages[start:]
+        if recalled:
+            messages.insert(0, recalled)
+    if summary:
+        messages.insert(0, summary.as_message())
+    summarizer.check(session, db_path, summary, on_usage=charge_summary(user))
+    session.close()
 
     # add system prompt
     system = {
@@ -480,7 +649,7 @@ def google_transcribe_audio(
     else:  # asynchronous processing
         logger.info(f"Processing {duration} sec long audio")
         text = "Your audio is longer than a minute. Processing might take longer than usual, please hold on."
-        message_id = send_text(text, number)
+        message_id = send_text(text, number, wait=True)
         # upload to google cloud storage
         bucket_name = "braintext_audio"
         destination_blob_name = f"{datetime.utcnow().strftime('%M%S%f')}"
@@ -760,30 +929,7 @@ def debit_user(
 # ChatGPT ----------------------------------
 def num_tokens_from_messages(messages, model="gpt-3.5-turbo-1106"):
     """Returns the number of tokens used by a list of messages."""
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        logger.error("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
-    if "gpt-3.5-turbo" in model:
-        tokens_per_message = (
-            4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-        )
-        tokens_per_name = -1  # if there's a name, the role is omitted
-    elif "gpt-4" in model:
-        tokens_per_message = 3
-        tokens_per_name = 1
-    else:
-        raise NotImplementedError(
-            f"""num_tokens_from_messages() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens."""
-        )
-    num_tokens = 0
-    for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(str(value)))
-            if key == "name":
-                num_tokens += tokens_per_name
+    num_tokens = sum(message_tokens(message, model) for message in messages)
     num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
     return num_tokens
 
@@ -838,128 +984,306 @@ def scrape_website(url, max_words=5000):
             os.remove(temp_filename)
 
 
+def stream_completion(on_text: Callable[[str], None], **kwargs) -> ChatCompletion:
+    """
+    Create a chat completion with `stream=True`, passing the text to
+    `on_text` as it arrives, and return it assembled as a `ChatCompletion`.
+    Tool calls are collected instead of passed on. Usage comes from the
+    last chunk of the stream, or is counted with tiktoken if it is missing.
+    """
+    extra_body = {"stream_options": {"include_usage": True}}
+    extra_body.update(kwargs.pop("extra_body", None) or {})
+    stream = openai_client.chat.completions.create(
+        stream=True, extra_body=extra_body, **kwargs
+    )
+    content, tool_calls = [], {}
+    role, finish_reason, usage, chunk = "assistant", "stop", None, None
+    for chunk in stream:
+        usage = getattr(chunk, "usage", None) or usage
+        if not chunk.choices:
+            continue
+        choice = chunk.choices[0]
+        role = choice.delta.role or role
+        finish_reason = choice.finish_reason or finish_reason
+        if choice.delta.tool_calls:
+            # each call arrives in pieces, keyed by its index
+            for delta in choice.delta.tool_calls:
+                call = tool_calls.setdefault(delta.index, ["", "", []])
+                call[0] = delta.id or call[0]
+                if delta.function:
+                    call[1] += delta.function.name or ""
+                    call[2].append(delta.function.arguments or "")
+        elif choice.delta.content:
+            content.append(choice.delta.content)
+            if not tool_calls:
+                on_text(choice.delta.content)
+    content = "".join(content)
+    tool_calls = [
+        ChatCompletionMessageToolCall(
+            id=call_id,
+            type="function",
+            function=Function(name=name, arguments="".join(arguments)),
+        )
+        for call_id, name, arguments in (
+            tool_calls[index] for index in sorted(tool_calls)
+        )
+    ]
+    if isinstance(usage, dict):
+        usage = CompletionUsage(**usage)
+    if not usage:
+        encoding = get_encoding()
+        prompt_tokens = num_tokens_from_messages(kwargs["messages"])
+        completion_tokens = len(
+            encoding.encode(
+                content
+                + "".join(
+                    call.function.name + call.function.arguments for call in tool_calls
+                )
+            )
+        )
+        usage = CompletionUsage(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            total_tokens=prompt_tokens + completion_tokens,
+        )
+    message = ChatCompletionMessage(
+        role=role, content=content or None, tool_calls=tool_calls or None
+    )
+    return ChatCompletion(
+        id=chunk.id if chunk else "",
+        choices=[Choice(index=0, finish_reason=finish_reason, message=message)],
+        created=chunk.created if chunk else int(datetime.now().timestamp()),
+        model=chunk.model if chunk else kwargs["model"],
+        object="chat.completion",
+        usage=usage,
+    )
+
+
+def response_cache_key(
+    data: WebhookEvent, user: User, messages: list, message: str, model: str
+) -> tuple | None:
+    """
+    Cache key for the answer to `message`, or `None` if the answer may
+    depend on the conversation: prompts sent with earlier messages, a
+    summary or recalled messages, replies, long prompts and prompts
+    referring to earlier messages, the user or the time.
+    This function is meant to be called internally
+    """
+    from ..chatbot.functions import is_reply
+
+    if not response_cache.maxsize or not message or len(message) > 200:
+        return None
+    # only the system prompt comes before the prompt
+    if [m["role"] for m in messages[:-1]] != ["system"]:
+        return None
+    prompt = " ".join(re.sub(r"[^\w\s]", " ", message.lower()).split())
+    if not prompt or CONTEXT_PATTERN.search(prompt) or is_reply(data):
+        return None
+    response_type = (
+        user.user_settings().response_type if isinstance(user, User) else "elaborated"
+    )
+    return prompt, response_type, model
+
+
+def run_tools(tool_calls: list, tokens: list, **kwargs) -> list:
+    """
+    Run the tools ChatGPT asked for in one turn and return the tool messages
+    to send back, in the order of `tool_calls`.
+    Callback tools run at the same time on `tool_pool`, each given its
+    `timeout`. A tool that times out keeps running, and holding one of the
+    `CHATGPT_TOOL_QUEUE_SIZE` slots, until it returns; only its result is
+    dropped. Other tools message the user themselves, so they run one after
+    the other on this thread while the callbacks are working.
+    This function is meant to be called internally
+    """
+    results = {}
+    futures = {}
+    actions = []
+    started = time.monotonic()
+    for call in tool_calls:
+        tool = CHATGPT_FUNCTIONS.get(call.function.name)
+        try:
+            if not tool:
+                raise ValueError(f"Unknown tool {call.function.name}")
+            arguments = json.loads(call.function.arguments or "{}")
+        except:
+            logger.error(traceback.format_exc())
+            results[call.id] = f"Error: invalid call to {call.function.name}."
+            continue
+        logger.info(f"FUNCTION CALL: {call.function.name} {arguments}")
+        arguments.update(kwargs, tokens=tokens)
+        if tool["type"] != "callback":
+            actions.append((call, tool, arguments))
+            continue
+        if not tool_slots.acquire(blocking=False):
+            logger.warning(f"TOOL QUEUE FULL. {call.function.name} NOT CALLED")
+            results[call.id] = "Error: too busy. Please try again later."
+            continue
+        fn = tool["function"]
+        if has_request_context():
+            # tools use url_for and the database
+            fn = copy_current_request_context(fn)
+        future = tool_pool.submit(fn, **arguments)
+        future.add_done_callback(lambda _: tool_slots.release())
+        futures[call.id] = (future, tool)
+
+    for call, tool, arguments in actions:
+        try:
+            tool["function"](**arguments)
+            results[call.id] = "Done. The user has been sent the result."
+        except:
+            logger.error(traceback.format_exc())
+            results[call.id] = f"Error: {call.function.name} failed."
+
+    for call_id, (future, tool) in futures.items():
+        timeout = tool.get("timeout", CHATGPT_TOOL_TIMEOUT)
+        try:
+            results[call_id] = future.result(
+                timeout=max(0, started + timeout - time.monotonic())
+            )
+        except FutureTimeoutError:
+            future.cancel()
+            logger.warning(f"TOOL CALL {call_id} TIMED OUT AFTER {timeout}s")
+            results[call_id] = "Error: this took too long. Please try again later."
+        except:
+            logger.error(traceback.format_exc())
+            results[call_id] = "Error: this failed. Please try again later."
+        logger.info(f"CALLBACK FUNCTION CALL RESULTS: {results[call_id]}")
+
+    return [
+        {"role": "tool", "tool_call_id": call.id, "content": str(results[call.id])}
+        for call in tool_calls
+    ]
+
+
 def chatgpt_response(
-    data: Dict[Any, Any],
+    data: WebhookEvent,
     user: User,
     messages: list,
     message: str,
     number: str,
     message_request: MessageRequest,
     message_id: str = None,
+    on_text: Callable[[str, int], None] = None,
 ) -> tuple | None:
-    """Get response from ChatGPT"""
+    """Get response from ChatGPT
+    \nWith `CHATGPT_STREAM` set and an `on_text` callback, the answer is
+    streamed to `on_text` as it is generated, with the number of the round
+    (rounds before the last end in tool calls). With `CHATGPT_CACHE_SIZE` set,
+    answers to standalone prompts are reused for the same prompt, costing
+    no tokens.
+    """
     from ..chatbot.functions import get_name
 
     try:
-        # Event to signal the status update function to stop if OpenAI responds on time
-        stop_event = threading.Event()
 
-        def status_update():
-            """Wait ```n``` seconds and send status update."""
-            if not stop_event.wait(15):
-                import random
-
-                text = random.choice(WAIT_MESSAGES)
-                (
-                    send_text(message=text, recipient=number)
-                    if not message_id
-                    else reply_to_message(
-                        message_id=message_id, recipient=number, message=text
-                    )
+        def send_status(text: str):
+            (
+                send_text(message=text, recipient=number, wait=False)
+                if not message_id
+                else reply_to_message(
+                    message_id=message_id, recipient=number, message=text, wait=False
                 )
+            )
 
-        # set timer
-        thread = threading.Thread(target=status_update)
-        thread.start()
-
-        # usage tokens
+        def status_update():
+            """Send a status update if OpenAI hasn't responded in time.
+            \nRuns on the timers thread, so the message is sent from
+            `status_pool` in case sends are not queued (`GRAPH_SEND_WORKERS=0`).
+            """
+            import random
+
+            if not status_pool.submit(send_status, random.choice(WAIT_MESSAGES)):
+                logger.warning("STATUS POOL FULL. STATUS UPDATE DROPPED")
+
+        # set timer, cancelled once OpenAI responds
+        status_timer = timers.call_later(15, status_update)
+
+        model = "gpt-3.5-turbo-0125"
+        cache_key = response_cache_key(data, user, messages, message, model)
+        if cache_key:
+            text = response_cache.get(cache_key)
+            if text:
+                logger.info(f"CACHED RESPONSE FOR {cache_key}")
+                return text, [0, 0], "assistant"
+
+        def create_completion(turn: int, **kwargs) -> ChatCompletion:
+            if not (CHATGPT_STREAM and on_text):
+                return openai_client.chat.completions.create(**kwargs)
+
+            def stream_text(text: str) -> None:
+                # the user is already reading the answer
+                status_timer.cancel()
+                on_text(text, turn)
+
+            return stream_completion(stream_text, **kwargs)
+
+        # usage tokens, summed over every round
         tokens = [0, 0]
 
         # get enabled functions
         if isinstance(user, User):
-            enabled_functions = [
-                description
-                for function in user.user_settings().functions()
-                for description in CHATGPT_FUNCTION_DESCRIPTIONS
-                if function["name"] == description["name"] and function["enabled"]
-            ]
+            tools_mask = tool_registry.user_mask(user.user_settings())
         else:
-            enabled_functions = CHATGPT_FUNCTION_DESCRIPTIONS + ANONYMOUS_FUNCTIONS
-
-        logger.info(
-            f"Enabled functions: {[func['name'] for func in enabled_functions]}"
-        )
-
-        completion = openai_client.chat.completions.create(
-            model="gpt-3.5-turbo-0125",
-            messages=messages,
-            temperature=1,
-            functions=enabled_functions,
-            function_call="auto",
-            max_tokens=user.user_settings().max_response_length
-            if isinstance(user, User)
-            else None,
-        )
-        # update tokens
-        tokens[0] += int(completion.usage.prompt_tokens)
-        tokens[1] += int(completion.usage.completion_tokens)
-        # check for function call
-        if completion.choices[0].message.function_call:
-            logger.info(completion.choices[0].message.function_call)
-            # get function name and arguments
-            function_name = completion.choices[0].message.function_call.name
-            function_arguments = json.loads(
-                completion.choices[0].message.function_call.arguments
-            )
-            # pass in the request data to the function to be called
-            function_arguments["data"] = data
-            # pass in the number of tokens used for logging
-            function_arguments["tokens"] = tokens
-            # pass in current user message
-            function_arguments["message"] = message
-            # pass in current user message request
-            function_arguments["message_request"] = message_request
-            # call function with arguments as kwargs
-            if CHATGPT_FUNCTIONS[function_name]["type"] == "callback":
-                messages.append(
-                    completion.choices[0].message.dict(exclude={"tool_calls"})
-                )
-                logger.info(f"FUNCTION CALL: {messages[-1]}")
-                results = CHATGPT_FUNCTIONS[function_name]["function"](
-                    **function_arguments
-                )
-                logger.info(f"CALLBACK FUNCTION CALL RESULTS: {results}")
-                messages.append(
-                    {"role": "function", "name": function_name, "content": str(results)}
+            tools_mask = tool_registry.all
+        tools = tool_registry.payload(tools_mask)
+
+        logger.info(f"Enabled functions: {tool_registry.names_for(tools_mask)}")
+
+        for turn in range(CHATGPT_TOOL_ROUNDS + 1):
+            options = {}
+            if tools:
+                # the last round has to answer in text
+                options["extra_body"] = tools
+                options["tool_choice"] = (
+                    "auto" if turn < CHATGPT_TOOL_ROUNDS else "none"
                 )
-                completion = openai_client.chat.completions.create(
-                    model="gpt-3.5-turbo-1106",
-                    messages=messages,
-                    temperature=1,
-                    functions=CHATGPT_FUNCTION_DESCRIPTIONS,
-                    function_call="auto",
-                )
-                # update tokens
-                tokens[0] += int(completion.usage.prompt_tokens)
-                tokens[1] += int(completion.usage.completion_tokens)
-
-                text = completion.choices[0].message.content
-                role = completion.choices[0].message.role
-                return text, tokens, role
-            else:
+            completion = create_completion(
+                turn,
+                model=model,
+                messages=messages,
+                temperature=1,
+                max_tokens=user.user_settings().max_response_length
+                if isinstance(user, User)
+                else None,
+                **options,
+            )
+            # update tokens
+            tokens[0] += int(completion.usage.prompt_tokens)
+            tokens[1] += int(completion.usage.completion_tokens)
+            response = completion.choices[0].message
+            # check for tool calls
+            if not response.tool_calls or turn == CHATGPT_TOOL_ROUNDS:
+                names = [user.first_name, user.last_name]
+                if (
+                    cache_key
+                    and turn == 0
+                    and response.content
+                    and not any(
+                        name and name.lower() in response.content.lower()
+                        for name in names
+                    )
+                ):
+                    response_cache.set(cache_key, response.content)
+                return response.content, tokens, response.role
+            logger.info(response.tool_calls)
+            messages.append(response.dict(exclude={"function_call"}))
+            # only callback results need another round
+            replied = all(
+                CHATGPT_FUNCTIONS.get(call.function.name, {}).get("type")
+                == "non-callback"
+                for call in response.tool_calls
+            )
+            if replied:
+                # the called functions reply to the user and charge for what
+                # they do, so charge for the completions before they run
                 # update request records
-                message_request.gpt_3_input = completion.usage.prompt_tokens
-                message_request.gpt_3_output = completion.usage.completion_tokens
+                message_request.gpt_3_input = tokens[0]
+                message_request.gpt_3_output = tokens[1]
                 message_request.update()
                 # charge user
-                cost = gpt_3_5_cost(
-                    {
-                        "input": completion.usage.prompt_tokens,
-                        "output": completion.usage.completion_tokens,
-                    }
-                )
+                cost = gpt_3_5_cost({"input": tokens[0], "output": tokens[1]})
                 bt_cost = cost * USD2BT
-                # charge user
                 debit_user(
                     user=user,
                     name=get_name(data),
@@ -967,31 +1291,33 @@ def chatgpt_response(
                     message_request=message_request,
                     reason="ChatGPT Function call",
                 )
-                logger.info(
-                    f"FUNCTION CALL TOKENS: {int(completion.usage.prompt_tokens), int(completion.usage.completion_tokens)}"
+                logger.info(f"FUNCTION CALL TOKENS: {tokens[0], tokens[1]}")
+            messages.extend(
+                run_tools(
+                    response.tool_calls,
+                    tokens,
+                    # pass in the request data to the function to be called
+                    data=data,
+                    # pass in current user message
+                    message=message,
+                    # pass in current user message request
+                    message_request=message_request,
                 )
-                CHATGPT_FUNCTIONS[function_name]["function"](**function_arguments)
+            )
+            if replied:
                 return None
-        else:
-            text = completion.choices[0].message.content
-            role = completion.choices[0].message.role
-
-            return text, tokens, role
     except:
         logger.error(traceback.format_exc())
         text = "Sorry, I can't respond to that at the moment. Plese try again later."
         return text, (0, 0), "assistant"
     finally:
-        # Signal the status update function to stop
-        stop_event.set()
-
-        # Wait for status update thread to complete
-        thread.join()
+        # OpenAI responded (or failed), no status update needed
+        status_timer.cancel()
 
 
 # ChatGPT Functions ----------------------------
 def generate_image(
-    data: Dict[Any, Any],
+    data: WebhookEvent,
     tokens: int,
     message: str,
     prompt: str,
@@ -1009,7 +1335,7 @@ def generate_image(
     name = get_name(data)
     number = f"+{get_number(data)}"
     response = kwargs.get("response")
-    user = User.query.filter(User.phone_no == number).one_or_none()
+    user = User.by_phone(number)
     image_confg = (
         user.user_settings().image_confg()
         if user
@@ -1017,9 +1343,7 @@ def generate_image(
     )
     image_type = image_confg.split(".")[0]
     if not user:
-        user = AnonymousUser.query.filter(
-            AnonymousUser.phone_no == number
-        ).one_or_none()
+        user = AnonymousUser.by_phone(number)
     logger.info(f"DALLE CONFG: {image_confg}")
     if "dalle2" in image_type:
         d2_res = image_confg.split(".")[1]
@@ -1104,7 +1428,7 @@ def generate_image(
 
 
 def speech_synthesis(
-    data: Dict[Any, Any],
+    data: WebhookEvent,
     tokens: tuple,
     message: str,
     text: str,
@@ -1122,12 +1446,10 @@ def speech_synthesis(
     # get user
     name = get_name(data)
     number = f"+{get_number(data)}"
-    user = User.query.filter(User.phone_no == number).one_or_none()
+    user = User.by_phone(number)
     if not user:
         anonymous = True
-        user = AnonymousUser.query.filter(
-            AnonymousUser.phone_no == number
-        ).one_or_none()
+        user = AnonymousUser.by_phone(number)
     try:
         if not text:
             text = "Error synthesizing speech. Please try again later."
@@ -1193,7 +1515,7 @@ def speech_synthesis(
 
 
 def google_search(
-    data: Dict[Any, Any],
+    data: WebhookEvent,
     query: str,
     **kwargs,
 ):
@@ -1240,7 +1562,7 @@ def google_search(
         return text
 
 
-def media_search(data: Dict[Any, Any], **kwargs):
+def media_search(data: WebhookEvent, **kwargs):
     from ..chatbot.functions import (
         get_number,
         get_name,
@@ -1328,7 +1650,7 @@ def media_search(data: Dict[Any, Any], **kwargs):
         return send_text(text, number)
 
 
-def web_scrapping(data: Dict[Any, Any], **kwargs):
+def web_scrapping(data: WebhookEvent, **kwargs):
     url = kwargs.get("url")
     instructions = kwargs.get("instruction", "Summarize this.")
     try:
@@ -1340,7 +1662,7 @@ def web_scrapping(data: Dict[Any, Any], **kwargs):
         return "Error scrapping URL."
 
 
-def create_account(data: Dict[Any, Any], **kwargs):
+def create_account(data: WebhookEvent, **kwargs):
     from ..chatbot.functions import (
         get_number,
         generate_interactive_button,
@@ -1394,24 +1716,6 @@ CHATGPT_FUNCTION_DESCRIPTIONS = [
             "required": ["text", "speed"],
         },
     },
-    {
-        "name": "speech_synthesis",
-        "description": "Performs text-to-speech synthesis on user request.",
-        "parameters": {
-            "type": "object",
-            "properties": {
-                "text": {
-                    "type": "string",
-                    "description": "Text to be synthesized into speech.",
-                },
-                "speed": {
-                    "type": "number",
-                    "description": "How fast or slow the synthesised speech should be. Values range from 0.25 to 4.0. The default is 1.0",
-                },
-            },
-            "required": ["text", "speed"],
-        },
-    },
     {
         "name": "google_search",
         "description": "Performs online searches to retrieve information only on explicit request.",
@@ -1481,7 +1785,7 @@ CHATGPT_FUNCTION_DESCRIPTIONS = [
     },
     {
         "name": "recharge_account",
-        "description": f"Creates a new account recharge request. Verify with the user the amount, currency, and bank from this list of banks: {[bank for bank in BANK_CODES.keys()]}. Non NGN requests are not accepted.",
+        "description": "Creates a new account recharge request. Verify with the user the amount, currency, and bank. Non NGN requests are not accepted.",
         "parameters": {
             "type": "object",
             "properties": {
@@ -1517,7 +1821,11 @@ ANONYMOUS_FUNCTIONS = [
     }
 ]
 
+tool_registry = ToolRegistry(CHATGPT_FUNCTION_DESCRIPTIONS + ANONYMOUS_FUNCTIONS)
+
 
+# callback results are sent back to ChatGPT, other functions reply to the user
+# themselves. callbacks may set a `timeout` in seconds
 CHATGPT_FUNCTIONS = {
     "generate_image": {
         "type": "non-callback",
@@ -1538,6 +1846,7 @@ CHATGPT_FUNCTIONS = {
     "web_scrapping": {
         "type": "callback",
         "function": web_scrapping,
+        "timeout": 20,
     },
     "get_account_balance": {
         "type": "non-callback",
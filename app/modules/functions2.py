@@ -10,13 +10,14 @@ from dotenv import load_dotenv
 from app import logger
 from config import Config
 from ..models import User
+from ..chatbot.events import WebhookEvent
 
 load_dotenv()
 
 FILES = Config.FILES
 
 
-def account_settings(data: Dict[Any, Any], **kwargs):
+def account_settings(data: WebhookEvent, **kwargs):
     from .functions import log_response, get_user_db
     from ..chatbot.functions import (
         send_text,
@@ -33,7 +34,7 @@ def account_settings(data: Dict[Any, Any], **kwargs):
     text = ""
 
     try:
-        user = User.query.filter(User.phone_no == number).one_or_none()
+        user = User.by_phone(number)
         if not user:
             text = "Access to this feature requires an account. Please create an account to proceed."
             return send_text(text, number)
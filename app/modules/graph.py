@@ -0,0 +1,159 @@
+# python imports
+import os
+import time
+import random
+import threading
+
+# installed imports
+import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+
+# local imports
+from .. import logger
+
+load_dotenv()
+
+TOKEN = os.getenv("META_VERIFY_TOKEN")
+PHONE_NUMBER_ID = os.getenv("PHONE_NUMBER_ID")
+BASE_URL = "https://graph.facebook.com/v17.0"
+GRAPH_TIMEOUT = float(os.getenv("GRAPH_TIMEOUT", 10))
+GRAPH_RETRIES = int(os.getenv("GRAPH_RETRIES", 3))
+GRAPH_POOL_SIZE = int(os.getenv("GRAPH_POOL_SIZE", 20))
+# rate limited or a transient server error
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class GraphClient:
+    """Meta Graph API client over one keep-alive connection pool.
+    \nEvery call has a timeout. Calls answered with a status in
+    `RETRY_STATUSES`, or that fail to connect, are retried up to `retries`
+    times with jittered exponential backoff (or the `Retry-After` Meta
+    sends). A POST that timed out waiting for a response is not retried, as
+    the message may already have been sent.
+    """
+
+    def __init__(
+        self,
+        token: str,
+        base_url: str = BASE_URL,
+        timeout: float = GRAPH_TIMEOUT,
+        retries: int = GRAPH_RETRIES,
+        pool_size: int = GRAPH_POOL_SIZE,
+        backoff: float = 0.5,
+        max_backoff: float = 8,
+    ) -> None:
+        self.base_url = base_url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update(
+            {"Content-Type": "application/json", "Authorization": f"Bearer {token}"}
+        )
+        self._lock = threading.Lock()
+        self._counters = {"requests": 0, "retries": 0, "errors": 0}
+        self._statuses = {}
+        self._latency = [0.0, 0.0]  # total, max
+
+    def _record(self, status, latency: float) -> None:
+        with self._lock:
+            self._counters["requests"] += 1
+            self._statuses[status] = self._statuses.get(status, 0) + 1
+            self._latency[0] += latency
+            self._latency[1] = max(self._latency[1], latency)
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self._counters[key] += 1
+
+    def _delay(self, attempt: int, response: requests.Response = None) -> float:
+        retry_after = (
+            response.headers.get("Retry-After") if response is not None else None
+        )
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.max_backoff)
+        delay = min(self.backoff * 2**attempt, self.max_backoff)
+        return random.uniform(delay / 2, delay)
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        timeout: float = None,
+        retries: int = None,
+        **kwargs,
+    ) -> requests.Response:
+        """Send a request, retrying transient failures up to `retries` times.
+        \n`url` may be a path relative to the Graph API base url. Raises the
+        last `requests` exception if every attempt failed to get a response.
+        """
+        if not url.startswith("http"):
+            url = f"{self.base_url}/{url}"
+        retries = self.retries if retries is None else retries
+        for attempt in range(retries + 1):
+            last = attempt == retries
+            start = time.monotonic()
+            try:
+                response = self.session.request(
+                    method, url, timeout=timeout or self.timeout, **kwargs
+                )
+            except requests.RequestException as e:
+                self._record(type(e).__name__, time.monotonic() - start)
+                read_timeout = isinstance(e, requests.ReadTimeout) and method != "GET"
+                if (
+                    last
+                    or read_timeout
+                    or not isinstance(e, (requests.ConnectionError, requests.Timeout))
+                ):
+                    self._count("errors")
+                    raise
+                logger.warning(f"GRAPH API {method} {url} FAILED: {e}. RETRYING")
+                self._count("retries")
+                time.sleep(self._delay(attempt))
+                continue
+            self._record(response.status_code, time.monotonic() - start)
+            if response.status_code in RETRY_STATUSES and not last:
+                logger.warning(
+                    f"GRAPH API {method} {url} RETURNED {response.status_code}. RETRYING"
+                )
+                self._count("retries")
+                time.sleep(self._delay(attempt, response))
+                continue
+            if response.status_code != 200:
+                self._count("errors")
+                logger.error(
+                    f"GRAPH API {method} {url} RETURNED {response.status_code}: {response.text}"
+                )
+            return response
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def send(
+        self, data: dict, phone_id: str = PHONE_NUMBER_ID, **kwargs
+    ) -> requests.Response:
+        """Post a message (or read receipt) to the messages endpoint."""
+        return self.post(f"{phone_id}/messages", json=data, **kwargs)
+
+    def stats(self) -> dict:
+        with self._lock:
+            requests_made = self._counters["requests"]
+            return {
+                **self._counters,
+                "statuses": {str(status): n for status, n in self._statuses.items()},
+                "latency_avg": (
+                    round(self._latency[0] / requests_made, 3) if requests_made else 0
+                ),
+                "latency_max": round(self._latency[1], 3),
+            }
+
+
+graph_api = GraphClient(TOKEN)
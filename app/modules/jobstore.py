@@ -0,0 +1,270 @@
+# python imports
+import json
+import time
+import sqlite3
+import threading
+from typing import Any, Dict, Union
+
+
+class Job:
+    """A claimed job. `payload` is the decoded JSON stored with `put`.
+    \nA claim can batch several jobs of one lane; `ids` then lists all of them
+    and `payload` holds their payloads joined in order.
+    """
+
+    __slots__ = ("id", "ids", "payload", "host_url", "attempts")
+
+    def __init__(self, id: int, payload: str, host_url: str, attempts: int) -> None:
+        self.id = id
+        self.ids = [id]
+        self.payload = json.loads(payload)
+        self.host_url = host_url
+        self.attempts = attempts
+
+
+class JobStore:
+    """Durable job table in SQLite with claim/lease/ack semantics.
+    \nA claimed job is leased to its worker until `lease_until`. Jobs whose
+    lease runs out without an ack (worker killed or restarted) are claimed
+    again by the next worker.
+    \nJobs put under the same `lane` are claimed one at a time in order: a
+    lane with a job under a live lease is skipped by other workers.
+    \nJobs put with a `kind` and a `delay` wait until no job of the same kind
+    has been put in their lane for `delay` seconds, then consecutive jobs of
+    that kind are claimed together as one batch.
+    """
+
+    def __init__(self, path: str, lease: int = 600, max_attempts: int = 3) -> None:
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+        self._setup()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _setup(self) -> None:
+        conn = self._connection()
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload TEXT NOT NULL,
+                host_url TEXT,
+                state TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                lease_until REAL,
+                created_at REAL NOT NULL,
+                updated_at REAL
+            )
+            """
+        )
+        # tables created before lanes existed
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(jobs)")]
+        if "lane" not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN lane TEXT")
+        if "started_at" not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN started_at REAL")
+        if "kind" not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN kind TEXT")
+            conn.execute("ALTER TABLE jobs ADD COLUMN ready_at REAL")
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_jobs_state ON jobs (state, id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_jobs_lane ON jobs (lane, state)")
+
+    def put(
+        self,
+        payload: Union[Dict[Any, Any], list],
+        host_url: str = None,
+        lane=None,
+        kind: str = None,
+        delay: float = 0,
+        max_delay: float = None,
+    ) -> int:
+        """Store a new pending job at the end of `lane` and return its id.
+        \nWith a `delay`, pending jobs of the same `kind` in the lane are held
+        back with it, but none longer than `max_delay` after it was put.
+        Putting a job without a delay releases the jobs held in its lane.
+        """
+        conn = self._connection()
+        now = time.time()
+        ready_at = now + delay if delay else None
+        if lane is not None:
+            if ready_at:
+                conn.execute(
+                    """
+                    UPDATE jobs SET ready_at = MIN(?, created_at + ?)
+                    WHERE lane = ? AND kind = ? AND state = 'pending'
+                    """,
+                    (ready_at, max_delay or delay * 4, lane, kind),
+                )
+            else:
+                conn.execute(
+                    """
+                    UPDATE jobs SET ready_at = NULL
+                    WHERE lane = ? AND state = 'pending' AND ready_at IS NOT NULL
+                    """,
+                    (lane,),
+                )
+        cursor = conn.execute(
+            """
+            INSERT INTO jobs (payload, host_url, lane, kind, ready_at, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            (json.dumps(payload), host_url, lane, kind, ready_at, now),
+        )
+        return cursor.lastrowid
+
+    def claim(self, batch: int = 20) -> Union[Job, None]:
+        """Lease the oldest pending (or expired) job whose lane is free,
+        together with up to `batch` jobs of the same kind queued behind it.
+        \nReturns `None` if there is nothing to do.
+        """
+        conn = self._connection()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                """
+                SELECT id, payload, host_url, attempts, lane, kind FROM jobs AS job
+                WHERE (
+                    state = 'pending'
+                    OR (state = 'processing' AND lease_until < :now)
+                )
+                AND (ready_at IS NULL OR ready_at <= :now)
+                AND NOT EXISTS (
+                    SELECT 1 FROM jobs AS busy
+                    WHERE busy.lane = job.lane AND busy.state = 'processing'
+                    AND busy.lease_until >= :now
+                )
+                AND NOT EXISTS (
+                    SELECT 1 FROM jobs AS earlier
+                    WHERE earlier.lane = job.lane AND earlier.state = 'pending'
+                    AND earlier.id < job.id
+                )
+                ORDER BY id LIMIT 1
+                """,
+                {"now": now},
+            ).fetchone()
+            if not row:
+                conn.execute("COMMIT")
+                return None
+            job = Job(row[0], row[1], row[2], row[3] + 1)
+            if row[5] is not None and batch:
+                following = conn.execute(
+                    """
+                    SELECT id, payload, kind FROM jobs
+                    WHERE lane = ? AND state = 'pending' AND id > ?
+                    ORDER BY id LIMIT ?
+                    """,
+                    (row[4], row[0], batch),
+                ).fetchall()
+                for id, payload, kind in following:
+                    if kind != row[5]:
+                        break
+                    job.ids.append(id)
+                    job.payload += json.loads(payload)
+            conn.execute(
+                f"""
+                UPDATE jobs SET state = 'processing', attempts = attempts + 1,
+                lease_until = ?, started_at = ?, updated_at = ?
+                WHERE id IN ({", ".join("?" * len(job.ids))})
+                """,
+                (now + self.lease, now, now, *job.ids),
+            )
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        return job
+
+    def _set_state(self, job: Job, state: str) -> None:
+        self._connection().execute(
+            f"""
+            UPDATE jobs SET state = ?, updated_at = ?
+            WHERE id IN ({", ".join("?" * len(job.ids))})
+            """,
+            (state, time.time(), *job.ids),
+        )
+
+    def ack(self, job: Job) -> None:
+        """Mark a job as done."""
+        self._set_state(job, "done")
+
+    def fail(self, job: Job, remaining: list = None) -> None:
+        """Release a failed job for retry, or park it after `max_attempts`.
+        \nWith `remaining`, only those payloads are retried: they replace the
+        payload of the job's first id and the rest of its batch is done.
+        """
+        if remaining is None or job.attempts >= self.max_attempts:
+            self._set_state(
+                job, "failed" if job.attempts >= self.max_attempts else "pending"
+            )
+            return
+        conn = self._connection()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "UPDATE jobs SET payload = ?, state = 'pending', updated_at = ? WHERE id = ?",
+                (json.dumps(remaining), now, job.id),
+            )
+            conn.execute(
+                f"""
+                UPDATE jobs SET state = 'done', updated_at = ?
+                WHERE id IN ({", ".join("?" * (len(job.ids) - 1))})
+                """,
+                (now, *job.ids[1:]),
+            )
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+
+    def purge(self, older_than: int = 86400) -> int:
+        """Delete finished jobs older than `older_than` seconds."""
+        cursor = self._connection().execute(
+            "DELETE FROM jobs WHERE state IN ('done', 'failed') AND updated_at < ?",
+            (time.time() - older_than,),
+        )
+        return cursor.rowcount
+
+    def depth(self) -> int:
+        """Number of jobs waiting to be claimed."""
+        return (
+            self._connection()
+            .execute("SELECT COUNT(*) FROM jobs WHERE state = 'pending'")
+            .fetchone()[0]
+        )
+
+    def stats(self, since: int = 3600, lanes: int = 20) -> dict:
+        """Job counts by state, and queue times over the last `since` seconds
+        for the `lanes` slowest lanes.
+        """
+        conn = self._connection()
+        rows = conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state")
+        stats = {state: count for state, count in rows.fetchall()}
+        rows = conn.execute(
+            """
+            SELECT lane, COUNT(*), AVG(started_at - created_at),
+            MAX(started_at - created_at) FROM jobs
+            WHERE started_at > ? GROUP BY lane
+            ORDER BY AVG(started_at - created_at) DESC LIMIT ?
+            """,
+            (time.time() - since, lanes),
+        )
+        stats["lane_waits"] = {
+            str(lane): {
+                "jobs": count,
+                "wait_avg": round(wait_avg, 3),
+                "wait_max": round(wait_max, 3),
+            }
+            for lane, count, wait_avg, wait_max in rows.fetchall()
+        }
+        return stats
@@ -0,0 +1,155 @@
+# python imports
+import os
+import sqlite3
+import threading
+import traceback
+from datetime import datetime
+from collections import OrderedDict
+from typing import List
+
+# installed imports
+from dotenv import load_dotenv
+from sqlalchemy import event
+
+# local imports
+from .. import logger
+from .workers import WorkerPool
+from .messages import Messages
+from .vectors import EmbeddingProvider, VectorIndex
+
+load_dotenv()
+
+# earlier messages found by relevance and added to each prompt (0 disables)
+CHATGPT_MEMORY_K = int(os.getenv("CHATGPT_MEMORY_K", 0))
+# "openai", or "hashing" for a local stand-in that needs no network
+CHATGPT_MEMORY_PROVIDER = os.getenv("CHATGPT_MEMORY_PROVIDER", "openai")
+CHATGPT_MEMORY_WORKERS = int(os.getenv("CHATGPT_MEMORY_WORKERS", 2))
+# size of the vectors, searches take about 0.6 ms per 10k messages at 128
+CHATGPT_MEMORY_DIM = int(os.getenv("CHATGPT_MEMORY_DIM", 128))
+# users whose vectors are kept in memory
+CHATGPT_MEMORY_USERS = int(os.getenv("CHATGPT_MEMORY_USERS", 256))
+# cleared by migrations, whose copied messages are not embedded
+indexing = [True]
+
+
+class Memory:
+    """Long-term memory of every user's conversation, searched by relevance.
+    \nEvery message stored in a conversation database is embedded on a
+    background thread and kept in the user's folder, in `memory.db` and a
+    `VectorIndex`, which are not wiped with the daily conversation. `recall`
+    returns the earlier messages most similar to a prompt.
+    """
+
+    def __init__(
+        self,
+        provider: EmbeddingProvider,
+        k: int = CHATGPT_MEMORY_K,
+        workers: int = CHATGPT_MEMORY_WORKERS,
+        users: int = CHATGPT_MEMORY_USERS,
+    ) -> None:
+        self.provider = provider
+        self.k = k
+        self.users = users
+        self.pool = WorkerPool("memory", workers, maxsize=1000) if k else None
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {"remembered": 0, "recalled": 0, "failed": 0}
+        if self.pool:
+            event.listen(Messages, "after_insert", self._after_insert)
+
+    def _after_insert(self, mapper, connection, target: Messages) -> None:
+        if not indexing[0]:
+            return
+        if target.content and target.role in ("user", "assistant"):
+            user_dir = os.path.dirname(target.db_path)
+            self.pool.submit(self.remember, user_dir, target.role, target.content)
+
+    def _index(self, user_dir: str) -> VectorIndex:
+        with self._lock:
+            # vectors of another size are kept apart
+            index = self._indexes.pop(user_dir, None) or VectorIndex(
+                os.path.join(user_dir, f"memory-{self.provider.dim}"),
+                self.provider.dim,
+            )
+            self._indexes[user_dir] = index
+            if len(self._indexes) > self.users:
+                self._indexes.popitem(last=False)
+            return index
+
+    @staticmethod
+    def _connect(user_dir: str) -> sqlite3.Connection:
+        conn = sqlite3.connect(os.path.join(user_dir, "memory.db"), timeout=30)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS memory "
+            "(id INTEGER PRIMARY KEY, role TEXT, content TEXT, created_at TEXT)"
+        )
+        return conn
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self._counters[key] += 1
+
+    def remember(self, user_dir: str, role: str, content: str) -> None:
+        """Embed a message and add it to the user's memory."""
+        try:
+            vector = self.provider.embed([content])
+            with self._connect(user_dir) as conn:
+                memory_id = conn.execute(
+                    "INSERT INTO memory (role, content, created_at) VALUES (?, ?, ?)",
+                    (role, content, datetime.utcnow().isoformat()),
+                ).lastrowid
+            conn.close()
+            self._index(user_dir).add([memory_id], vector)
+            self._count("remembered")
+        except:
+            self._count("failed")
+            logger.error(traceback.format_exc())
+
+    def recall(self, user_dir: str, text: str, exclude: List[str] = ()) -> List[dict]:
+        """The `k` earlier messages most relevant to `text`, oldest first.
+        \nMessages whose content is in `exclude` (already in the prompt) are
+        skipped.
+        """
+        if not self.k or not text:
+            return []
+        try:
+            index = self._index(user_dir)
+            if not len(index):
+                return []
+            exclude = set(exclude)
+            # the excluded messages are likely to be among the best matches
+            matches = index.search(
+                self.provider.embed([text])[0], self.k + len(exclude)
+            )
+            ids = [memory_id for memory_id, _ in matches]
+            if not ids:
+                return []
+            with self._connect(user_dir) as conn:
+                rows = conn.execute(
+                    f"SELECT id, role, content FROM memory WHERE id IN ({','.join('?' * len(ids))})",
+                    ids,
+                ).fetchall()
+            conn.close()
+            found = {memory_id: (role, content) for memory_id, role, content in rows}
+            recalled = []
+            for memory_id in ids:
+                if memory_id not in found or found[memory_id][1] in exclude:
+                    continue
+                role, content = found[memory_id]
+                exclude.add(content)
+                recalled.append((memory_id, {"role": role, "content": content}))
+                if len(recalled) == self.k:
+                    break
+            self._count("recalled")
+            return [message for _, message in sorted(recalled, key=lambda m: m[0])]
+        except:
+            self._count("failed")
+            logger.error(traceback.format_exc())
+            return []
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = {"k": self.k, "users": len(self._indexes), **self._counters}
+        if self.pool:
+            stats["pool"] = self.pool.stats()
+        return stats
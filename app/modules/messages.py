@@ -1,24 +1,102 @@
+import os
+import time
+import functools
+import threading
+import traceback
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Union
+
+import tiktoken
+from dotenv import load_dotenv
 from sqlalchemy.orm import sessionmaker, declarative_base
-from sqlalchemy import create_engine, Column, Integer, String
+from sqlalchemy import (
+    create_engine,
+    delete,
+    event,
+    inspect,
+    text,
+    Column,
+    DateTime,
+    Index,
+    Integer,
+    String,
+)
+
+from .. import logger
+from config import Config
+from .userdirs import folder_number
+from .timers import timers
 
+load_dotenv()
 
 Base = declarative_base()
+DEFAULT_MODEL = "gpt-3.5-turbo-1106"
+# message databases kept open per process, and seconds an unused one stays open
+MESSAGES_OPEN_DBS = int(os.getenv("MESSAGES_OPEN_DBS", 64))
+MESSAGES_DB_IDLE = int(os.getenv("MESSAGES_DB_IDLE", 300))
+# "files" keeps a messages.db per user, "sqlite" one shared database
+CONVERSATION_STORE = os.getenv("CONVERSATION_STORE", "files")
+CONVERSATION_DB = Config.CONVERSATION_DB
+# days messages are kept in the shared database
+CONVERSATION_RETENTION_DAYS = int(os.getenv("CONVERSATION_RETENTION_DAYS", 7))
+
+
+def user_key(db_path: str) -> str:
+    """The user a conversation belongs to: the number in its folder's name."""
+    folder = os.path.basename(os.path.dirname(db_path))
+    return folder_number(folder) or folder
+
+
+class ConversationMixin(object):
+    # set in the shared database, where rows of every user live together
+    user_key = Column(String)
+    created_at = Column(DateTime, default=datetime.utcnow)
 
+    @classmethod
+    def query_for(cls, session, db_path: str):
+        """
+        Query the rows of the conversation at `db_path`.
+        In the shared database that is the user's rows from today, as a
+        user's messages.db is started again each day.
+        """
+        query = session.query(cls)
+        if CONVERSATION_STORE == "sqlite":
+            today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+            query = query.filter(
+                cls.user_key == user_key(db_path), cls.created_at >= today
+            )
+        return query
 
-class Messages(Base):
+
+class Messages(Base, ConversationMixin):
     __tablename__ = "messages"
+    __table_args__ = (
+        Index("ix_messages_user_key_id", "user_key", "id"),
+        Index("ix_messages_created_at", "created_at"),
+    )
     id = Column(Integer, primary_key=True)
     role = Column(String)
     content = Column(String)
+    # tokens the message adds to a prompt, see `message_tokens`
+    tokens = Column(Integer)
 
     def __init__(self, message, db_path):
         self.role = message["role"]
         self.content = message["content"]
         self.db_path = db_path
+        self.user_key = user_key(db_path)
+        try:
+            self.tokens = message_tokens(self.as_dict())
+        except:
+            # counted when the conversation is next loaded
+            logger.error(traceback.format_exc())
+
+    def as_dict(self) -> dict:
+        return {"role": self.role, "content": self.content if self.content else ""}
 
     def session(self):
-        Session = sessionmaker(bind=get_engine(self.db_path))
-        return Session()
+        return get_session(self.db_path)
 
     def insert(self):
         session = self.session()
@@ -27,9 +105,256 @@ class Messages(Base):
         session.close()
 
 
+class Summary(Base, ConversationMixin):
+    __tablename__ = "summary"
+    __table_args__ = (Index("ix_summary_user_key_id", "user_key", "id"),)
+    id = Column(Integer, primary_key=True)
+    content = Column(String)
+    # the newest message folded into this summary
+    last_message_id = Column(Integer)
+    tokens = Column(Integer)
+
+    def __init__(self, content: str, last_message_id: int, db_path: str):
+        self.user_key = user_key(db_path)
+        self.content = content
+        self.last_message_id = last_message_id
+        self.tokens = message_tokens(self.as_message())
+
+    def as_message(self) -> dict:
+        return {
+            "role": "system",
+            "content": f"Summary of the conversation so far: {self.content}",
+        }
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str = DEFAULT_MODEL):
+    """The tiktoken encoding for `model`, loaded once per process."""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        logger.error("Warning: model not found. Using cl100k_base encoding.")
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def message_tokens(message: dict, model: str = DEFAULT_MODEL) -> int:
+    """Tokens `message` adds to a prompt for `model`.
+    \nA prompt costs the sum over its messages plus 3 for the reply primer.
+    """
+    if "gpt-3.5-turbo" in model:
+        tokens_per_message = (
+            4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
+        )
+        tokens_per_name = -1  # if there's a name, the role is omitted
+    elif "gpt-4" in model:
+        tokens_per_message = 3
+        tokens_per_name = 1
+    else:
+        raise NotImplementedError(
+            f"""num_tokens_from_messages() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens."""
+        )
+    encoding = get_encoding(model)
+    num_tokens = tokens_per_message
+    for key, value in message.items():
+        num_tokens += len(encoding.encode(str(value)))
+        if key == "name":
+            num_tokens += tokens_per_name
+    return num_tokens
+
+
+class EngineCache:
+    """Engines for the per-user message databases, opened once per process.
+    \nThe schema is checked when a database is opened. At most `maxsize`
+    databases are kept open, the least recently used is closed first, and
+    any left unused for `idle` seconds are closed too. A database deleted or
+    replaced on disk (the daily wipe, maybe by another process) is reopened.
+    \nClosing an engine only closes the connections in its pool, so sessions
+    already using it keep working until they are closed.
+    """
+
+    def __init__(self, maxsize: int = MESSAGES_OPEN_DBS, idle: int = MESSAGES_DB_IDLE):
+        self.maxsize = maxsize
+        self.idle = idle
+        # db path -> [engine, sessionmaker, file stamp, last used]
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "opened": 0, "closed": 0}
+
+    @staticmethod
+    def _stamp(db_path: str) -> Union[tuple, None]:
+        """
+        What identifies the file at `db_path`. A file deleted and created
+        again may get the same inode, but not the same change time.
+        This function is meant to be called internally
+        """
+        try:
+            stat = os.stat(db_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_dev, stat.st_ino, stat.st_ctime_ns
+
+    def _restamp(self, db_path: str, entry: list) -> None:
+        """
+        Take the change time of this process' own writes to `db_path`, so
+        only other processes' writes and replacements reopen it.
+        This function is meant to be called internally
+        """
+        stamp = self._stamp(db_path)
+        with self._lock:
+            if stamp and entry[2] and stamp[:2] == entry[2][:2]:
+                entry[2] = stamp
+
+    def _open(self, db_path: str) -> list:
+        engine = create_engine(f"sqlite:///{db_path}", pool_size=1, max_overflow=4)
+        if db_path == CONVERSATION_DB:
+            # many writers, and no fsync of the whole file per message
+            event.listen(engine, "connect", _use_wal)
+        create_all(engine)
+        session = sessionmaker(bind=engine)
+        entry = [engine, session, self._stamp(db_path), 0]
+        event.listen(session, "after_commit", lambda _: self._restamp(db_path, entry))
+        return entry
+
+    def _evict(self, now: float) -> list:
+        """
+        Drop entries over the size limit or idle for too long and return
+        their engines to be closed.
+        This function is meant to be called internally
+        """
+        closed = []
+        while self._entries:
+            path, entry = next(iter(self._entries.items()))
+            if len(self._entries) <= self.maxsize and now - entry[3] < self.idle:
+                break
+            del self._entries[path]
+            closed.append(entry[0])
+        return closed
+
+    def _close(self, engines: list) -> None:
+        for engine in engines:
+            engine.dispose()
+        if engines:
+            with self._lock:
+                self._counters["closed"] += len(engines)
+
+    def get(self, db_path: str) -> list:
+        now = time.monotonic()
+        stamp = self._stamp(db_path)
+        with self._lock:
+            entry = self._entries.pop(db_path, None)
+            stale = entry if entry and entry[2] != stamp else None
+            if entry and not stale:
+                self._counters["hits"] += 1
+        if not entry or stale:
+            entry = self._open(db_path)
+            with self._lock:
+                self._counters["opened"] += 1
+        entry[3] = now
+        with self._lock:
+            replaced = self._entries.pop(db_path, None)
+            self._entries[db_path] = entry
+            closed = self._evict(now)
+        self._close(
+            [old[0] for old in (stale, replaced) if old and old is not entry] + closed
+        )
+        return entry
+
+    def forget(self, db_path: str) -> None:
+        """Close `db_path` before it is deleted.
+        \nSessions already open still write to the deleted file, see
+        `Summarizer.busy` before deleting one that may be summarized.
+        """
+        with self._lock:
+            entry = self._entries.pop(db_path, None)
+        self._close([entry[0]] if entry else [])
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"open": len(self._entries), **self._counters}
+
+
+engines = EngineCache()
+
+
+def _use_wal(connection, _) -> None:
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+
+
+def store_path(db_path: str) -> str:
+    """The database file a conversation is stored in."""
+    return CONVERSATION_DB if CONVERSATION_STORE == "sqlite" else db_path
+
+
 def get_engine(db_path: str):
-    return create_engine(f"sqlite:///{db_path}")
+    return engines.get(store_path(db_path))[0]
+
+
+def get_session(db_path: str):
+    return engines.get(store_path(db_path))[1]()
+
+
+_purge_lock = threading.Lock()
+_purge_scheduled = [False]
+
+
+def purge_conversations(days: int = CONVERSATION_RETENTION_DAYS) -> int:
+    """Delete rows older than `days` from the shared database. Returns how many."""
+    session = engines.get(CONVERSATION_DB)[1]()
+    try:
+        cutoff = datetime.utcnow() - timedelta(days=days)
+        deleted = 0
+        for model in (Messages, Summary):
+            deleted += session.execute(
+                delete(model).where(model.created_at < cutoff)
+            ).rowcount
+        session.commit()
+        return deleted
+    finally:
+        session.close()
+
+
+def schedule_purge(every: int = 3600) -> None:
+    """Purge the shared database now and every `every` seconds after.
+    \nEach purge runs on a thread of its own, started by the timers thread,
+    so it holds up neither requests nor other timers. Does nothing if the
+    purge is already scheduled in this process.
+    """
+    with _purge_lock:
+        if _purge_scheduled[0]:
+            return
+        _purge_scheduled[0] = True
+
+    def purge():
+        try:
+            deleted = purge_conversations()
+            if deleted:
+                logger.info(f"PURGED {deleted} OLD CONVERSATION ROWS")
+        except:
+            logger.error(traceback.format_exc())
+        finally:
+            timers.call_later(every, start)
+
+    def start():
+        threading.Thread(target=purge, name="purge", daemon=True).start()
+
+    start()
 
 
 def create_all(engine):
     Base.metadata.create_all(engine)
+    # databases created before some of the columns
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            columns = [
+                column["name"] for column in inspect(connection).get_columns(table.name)
+            ]
+            for column in table.columns:
+                if column.name not in columns:
+                    connection.execute(
+                        text(
+                            f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(engine.dialect)}"
+                        )
+                    )
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
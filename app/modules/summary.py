@@ -0,0 +1,177 @@
+# python imports
+import os
+import threading
+import traceback
+from typing import Callable, Union
+
+# installed imports
+from dotenv import load_dotenv
+from sqlalchemy import desc, func
+
+# local imports
+from .. import logger
+from .workers import WorkerPool
+from .messages import Messages, Summary, get_session
+
+load_dotenv()
+
+# fold older messages into a summary once the messages after the last summary
+# pass this many tokens (0 disables summaries)
+CHATGPT_SUMMARY_TOKENS = int(os.getenv("CHATGPT_SUMMARY_TOKENS", 0))
+CHATGPT_SUMMARY_WORKERS = int(os.getenv("CHATGPT_SUMMARY_WORKERS", 2))
+SUMMARY_PROMPT = (
+    "You keep a running summary of a WhatsApp conversation between a user and "
+    "an assistant. Update the summary with the new messages. Keep the facts, "
+    "names, preferences and open questions the assistant will need later, and "
+    "drop small talk. Reply with the summary only, in under 200 words."
+)
+
+
+class Summarizer:
+    """Folds the older messages of a conversation into a running summary.
+    \nOnce the messages after the last summary pass `threshold` tokens, the
+    oldest of them are summarized together with that summary on a background
+    thread, keeping about `threshold / 2` tokens of the newest messages as
+    they are. `load_messages` then sends the summary and the messages after
+    it, so prompts stay about the same size however long the conversation.
+    """
+
+    def __init__(
+        self,
+        client,
+        threshold: int = CHATGPT_SUMMARY_TOKENS,
+        workers: int = CHATGPT_SUMMARY_WORKERS,
+        model: str = "gpt-3.5-turbo-0125",
+        max_tokens: int = 400,
+    ) -> None:
+        self.client = client
+        self.threshold = threshold
+        self.model = model
+        self.max_tokens = max_tokens
+        self.pool = (
+            WorkerPool("summarizer", workers, maxsize=1000)
+            if threshold and workers
+            else None
+        )
+        # conversations with a summary on the way
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._counters = {
+            "summaries": 0,
+            "folded": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+        }
+
+    def latest(self, session, db_path: str) -> Union[Summary, None]:
+        """The newest summary of the conversation at `db_path`, if summaries are on."""
+        if not self.threshold:
+            return None
+        return Summary.query_for(session, db_path).order_by(desc(Summary.id)).first()
+
+    def check(
+        self,
+        session,
+        db_path: str,
+        summary: Summary = None,
+        on_usage: Callable = None,
+    ) -> bool:
+        """Queue a summary of `db_path` if it has grown past `threshold`.
+        \n`on_usage` is called with the usage of the summary's completion, to
+        charge for it. Returns `True` if one was queued.
+        """
+        if not self.pool:
+            return False
+        query = Messages.query_for(session, db_path).with_entities(
+            func.sum(Messages.tokens)
+        )
+        if summary:
+            query = query.filter(Messages.id > summary.last_message_id)
+        if (query.scalar() or 0) <= self.threshold:
+            return False
+        with self._lock:
+            if db_path in self._pending:
+                return False
+            self._pending.add(db_path)
+        if not self.pool.submit(self.summarize, db_path, on_usage):
+            with self._lock:
+                self._pending.discard(db_path)
+            return False
+        return True
+
+    def busy(self, db_path: str) -> bool:
+        """Whether a summary of `db_path` is queued or being written."""
+        with self._lock:
+            return db_path in self._pending
+
+    def summarize(
+        self, db_path: str, on_usage: Callable = None
+    ) -> Union[Summary, None]:
+        """Fold the older messages of `db_path` into a new summary."""
+        session = get_session(db_path)
+        try:
+            summary = self.latest(session, db_path)
+            query = Messages.query_for(session, db_path)
+            if summary:
+                query = query.filter(Messages.id > summary.last_message_id)
+            rows = query.order_by(Messages.id).all()
+            # keep the newest messages as they are
+            kept = 0
+            end = len(rows)
+            while end and kept + (rows[end - 1].tokens or 0) <= self.threshold // 2:
+                end -= 1
+                kept += rows[end].tokens or 0
+            folded = rows[:end] or rows[:1]
+            if not folded:
+                return None
+            transcript = "\n".join(
+                f"{row.role}: {row.content}" for row in folded if row.content
+            )
+            previous = summary.content if summary else "(none yet)"
+            completion = self.client.chat.completions.create(
+                model=self.model,
+                messages=[
+                    {"role": "system", "content": SUMMARY_PROMPT},
+                    {
+                        "role": "user",
+                        "content": f"Summary so far:\n{previous}\n\nNew messages:\n{transcript}",
+                    },
+                ],
+                temperature=0.3,
+                max_tokens=self.max_tokens,
+            )
+            usage = completion.usage
+            new_summary = Summary(
+                completion.choices[0].message.content, folded[-1].id, db_path
+            )
+            session.add(new_summary)
+            session.commit()
+            logger.info(
+                f"SUMMARIZED {len(folded)} MESSAGES IN {db_path}. TOKENS: {usage.prompt_tokens, usage.completion_tokens}"
+            )
+            with self._lock:
+                self._counters["summaries"] += 1
+                self._counters["folded"] += len(folded)
+                self._counters["prompt_tokens"] += usage.prompt_tokens
+                self._counters["completion_tokens"] += usage.completion_tokens
+            if on_usage:
+                on_usage(usage)
+            return new_summary
+        except:
+            logger.error(traceback.format_exc())
+            return None
+        finally:
+            session.close()
+            with self._lock:
+                self._pending.discard(db_path)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = {
+                "threshold": self.threshold,
+                "pending": len(self._pending),
+                **self._counters,
+            }
+        if self.pool:
+            stats["pool"] = self.pool.stats()
+        return stats
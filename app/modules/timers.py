@@ -0,0 +1,117 @@
+# python imports
+import time
+import heapq
+import itertools
+import threading
+import traceback
+
+# local imports
+from .. import logger
+
+
+class TimerHandle:
+    """A scheduled callback. `cancel` stops it from running if it hasn't yet."""
+
+    __slots__ = ("when", "fn", "args", "kwargs", "active", "_scheduler")
+
+    def __init__(self, scheduler, when: float, fn, args, kwargs) -> None:
+        self._scheduler = scheduler
+        self.when = when
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        # until it runs or is cancelled
+        self.active = True
+
+    def cancel(self) -> None:
+        self._scheduler._cancel(self)
+
+
+class TimerScheduler:
+    """Process-wide deadlines on a heap, run by a single daemon thread.
+    \nCallbacks run on the scheduler thread, so they should be quick (queue
+    a message, set an event) and leave slow work to a worker pool. The
+    thread is started on first use so that it lives in the gunicorn worker
+    and not in the master.
+    """
+
+    def __init__(self, name: str = "timers") -> None:
+        self.name = name
+        self._heap = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._counters = {"scheduled": 0, "fired": 0, "cancelled": 0}
+        self._cancelled_waiting = 0
+
+    def _start(self) -> None:
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def _cancel(self, handle: TimerHandle) -> None:
+        with self._condition:
+            if not handle.active:
+                return
+            handle.active = False
+            self._counters["cancelled"] += 1
+            self._cancelled_waiting += 1
+            # drop cancelled timers once they make up most of the heap
+            if self._cancelled_waiting > 100 and self._cancelled_waiting * 2 > len(
+                self._heap
+            ):
+                self._heap = [entry for entry in self._heap if entry[2].active]
+                heapq.heapify(self._heap)
+                self._cancelled_waiting = 0
+
+    def call_later(self, delay: float, fn, *args, **kwargs) -> TimerHandle:
+        """Run `fn(*args, **kwargs)` in `delay` seconds."""
+        with self._condition:
+            self._start()
+            handle = TimerHandle(self, time.monotonic() + delay, fn, args, kwargs)
+            heapq.heappush(self._heap, (handle.when, next(self._sequence), handle))
+            self._counters["scheduled"] += 1
+            # wake the thread if this is now the earliest deadline
+            if self._heap[0][2] is handle:
+                self._condition.notify()
+        return handle
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while True:
+                    if not self._heap:
+                        self._condition.wait()
+                        continue
+                    when, _, handle = self._heap[0]
+                    if not handle.active:
+                        heapq.heappop(self._heap)
+                        self._cancelled_waiting = max(0, self._cancelled_waiting - 1)
+                        continue
+                    delay = when - time.monotonic()
+                    if delay > 0:
+                        self._condition.wait(delay)
+                        continue
+                    heapq.heappop(self._heap)
+                    handle.active = False
+                    self._counters["fired"] += 1
+                    break
+            try:
+                handle.fn(*handle.args, **handle.kwargs)
+            except:
+                logger.error(traceback.format_exc())
+
+    def pending(self) -> int:
+        with self._condition:
+            return len(self._heap) - self._cancelled_waiting
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                "pending": len(self._heap) - self._cancelled_waiting,
+                **self._counters,
+            }
+
+
+timers = TimerScheduler()
@@ -0,0 +1,189 @@
+# python imports
+import os
+import time
+import queue
+import atexit
+import threading
+import traceback
+from datetime import datetime
+from collections import OrderedDict
+from typing import Callable
+
+# local imports
+from .. import logger
+from .cache import LRUCache
+
+
+class TranscriptWriter:
+    """Appends chat transcript lines to the users' log files in the background.
+    \nLines are buffered per file by a single daemon thread and written once
+    `max_lines` are waiting or `interval` seconds after the first of them.
+    Each file is located (and its folders created) once per process with
+    `locate(name, number, when)`, and the `open_files` most recently written
+    files are kept open. A crash loses at most the last `interval` seconds
+    of lines; they are flushed when the process exits normally, and should
+    be flushed with `flush` by processes that don't (multiprocessing
+    children skip `atexit`).
+    \nWith `interval` 0 lines are written on the calling thread. When the
+    queue is full, `write` waits for room, so lines stay in order.
+    """
+
+    def __init__(
+        self,
+        locate: Callable[[str, str, datetime], str],
+        interval: float = 0,
+        max_lines: int = 200,
+        open_files: int = 128,
+        maxsize: int = 10000,
+    ) -> None:
+        self.locate = locate
+        self.interval = interval
+        self.max_lines = max_lines
+        self.open_files = open_files
+        self._queue = queue.Queue(maxsize=maxsize)
+        # (name, number, day) -> [name, number, when, lines]
+        self._buffers = {}
+        self._buffered = 0
+        self._deadline = None
+        self._paths = LRUCache(10000)
+        self._files = OrderedDict()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._counters = {
+            "lines": 0,
+            "flushes": 0,
+            "inline": 0,
+            "waited": 0,
+            "failed": 0,
+        }
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._thread:
+                return
+            self._thread = threading.Thread(
+                target=self._run, name="transcripts", daemon=True
+            )
+            self._thread.start()
+        atexit.register(self.flush)
+
+    def _count(self, key: str, n: int = 1) -> None:
+        with self._lock:
+            self._counters[key] += n
+
+    def write(self, name: str, number: str, when: datetime, line: str) -> None:
+        """Append `line` to the user's log for the day of `when`."""
+        if self.interval > 0:
+            self._start()
+            item = (name, number, when, line)
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                # written here, the line would go before older queued ones
+                self._count("waited")
+                self._queue.put(item)
+            return
+        self._count("inline")
+        with open(self.locate(name, number, when), "a") as file:
+            file.write(line)
+        self._count("lines")
+
+    def flush(self, timeout: float = 10) -> bool:
+        """Write everything queued so far. Returns `False` on timeout."""
+        if not self._thread:
+            return True
+        done = threading.Event()
+        try:
+            self._queue.put(done, timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(timeout)
+
+    def _run(self) -> None:
+        while True:
+            timeout = (
+                max(self._deadline - time.monotonic(), 0) if self._deadline else None
+            )
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if isinstance(item, threading.Event):
+                self._write_buffers()
+                item.set()
+                continue
+            if item:
+                name, number, when, line = item
+                key = (name, number, when.strftime("%d-%m-%Y"))
+                buffer = self._buffers.get(key)
+                if buffer is None:
+                    buffer = self._buffers[key] = [name, number, when, []]
+                buffer[3].append(line)
+                self._buffered += 1
+                if self._deadline is None:
+                    self._deadline = time.monotonic() + self.interval
+            if self._buffered >= self.max_lines or (
+                self._deadline and time.monotonic() >= self._deadline
+            ):
+                self._write_buffers()
+
+    def _file(self, path: str):
+        """
+        An open handle for appending to `path`, reopened if the file was
+        moved or removed since.
+        This function is meant to be called internally
+        """
+        file = self._files.pop(path, None)
+        if file:
+            try:
+                stale = os.stat(path).st_ino != os.fstat(file.fileno()).st_ino
+            except FileNotFoundError:
+                stale = True
+            if stale:
+                file.close()
+                file = None
+        if not file:
+            file = open(path, "a")
+        self._files[path] = file
+        while len(self._files) > self.open_files:
+            self._files.popitem(last=False)[1].close()
+        return file
+
+    def _write_buffers(self) -> None:
+        buffers, self._buffers = self._buffers, {}
+        self._buffered = 0
+        self._deadline = None
+        for key, (name, number, when, lines) in buffers.items():
+            for attempt in range(2):
+                try:
+                    path = self._paths.get(key)
+                    if path is None:
+                        path = self.locate(name, number, when)
+                        self._paths.set(key, path)
+                    file = self._file(path)
+                    file.write("".join(lines))
+                    file.flush()
+                    self._count("lines", len(lines))
+                    break
+                except FileNotFoundError:
+                    # the folder was moved or removed, locate it again
+                    self._paths.pop(key)
+                    if attempt:
+                        self._count("failed", len(lines))
+                        logger.error(traceback.format_exc())
+                except:
+                    self._count("failed", len(lines))
+                    logger.error(traceback.format_exc())
+                    break
+        if buffers:
+            self._count("flushes")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "interval": self.interval,
+                "queued": self._queue.qsize(),
+                "buffered": self._buffered,
+                "open_files": len(self._files),
+                **self._counters,
+            }
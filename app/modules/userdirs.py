@@ -0,0 +1,219 @@
+# python imports
+import os
+import shutil
+import sqlite3
+import hashlib
+import threading
+from typing import Iterator, Tuple, Union
+
+
+def number_key(number: str) -> str:
+    """`number` with only its digits, as it appears in folder names."""
+    return "".join(char for char in str(number) if char.isdigit())
+
+
+def folder_number(folder: str) -> Union[str, None]:
+    """The phone number a user folder (`<display_name>_<number>`) belongs to."""
+    _, _, number = os.path.basename(folder).rpartition("_")
+    return number if number.isdigit() else None
+
+
+def hashed_dir(chatlog_dir: str, number: str) -> str:
+    """The user's folder in the hashed layout: `<chatlog_dir>/ab/cd/<number>`.
+    \n`ab/cd` are the first bytes of the SHA-1 of the number, so the 65536
+    shards fill evenly and the folder never depends on the display name.
+    """
+    number = number_key(number)
+    digest = hashlib.sha1(number.encode()).hexdigest()
+    return os.path.join(chatlog_dir, digest[:2], digest[2:4], number)
+
+
+def user_folders(chatlog_dir: str) -> Iterator[Tuple[str, str, bool]]:
+    """Every user folder in the log tree as `(number, path, hashed)`.
+    \nFolders of the name-based layout (`AAA/<name>_<number>`) and of the
+    hashed layout (`ab/cd/<number>`) may sit side by side while migrating.
+    """
+    for group in os.scandir(chatlog_dir):
+        if not group.is_dir():
+            continue
+        if len(group.name) == 2:
+            shards = [shard for shard in os.scandir(group.path) if shard.is_dir()]
+        else:
+            shards = [group]
+        for shard in shards:
+            for folder in os.scandir(shard.path):
+                number = folder_number(folder.name)
+                if number and folder.is_dir():
+                    yield number, os.path.normpath(folder.path), shard is not group
+
+
+def merge_dir(src: str, dst: str) -> None:
+    """Move the contents of the older folder `src` into `dst` and remove `src`.
+    \nA missing `dst` is a single rename. Otherwise files are moved one by
+    one: the lines of a log of the same day go before the ones already in
+    `dst`, and the other files in `dst` (its message database, its memory)
+    are newer and kept, so folders should be merged newest first. Lines
+    written to `dst` while its logs are merged may be lost.
+    """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        os.rename(src, dst)
+        return
+    except FileNotFoundError:
+        # moved by another process
+        return
+    except OSError:
+        pass
+    for root, _, files in os.walk(src):
+        target = os.path.normpath(os.path.join(dst, os.path.relpath(root, src)))
+        os.makedirs(target, exist_ok=True)
+        for name in files:
+            source = os.path.join(root, name)
+            destination = os.path.join(target, name)
+            if not os.path.exists(destination):
+                os.replace(source, destination)
+            elif name.endswith(".log"):
+                # the older lines go first
+                merged = f"{destination}.merging"
+                with open(merged, "wb") as new:
+                    for path in (source, destination):
+                        with open(path, "rb") as old:
+                            shutil.copyfileobj(old, new)
+                os.replace(merged, destination)
+                os.remove(source)
+            else:
+                os.remove(source)
+    shutil.rmtree(src, ignore_errors=True)
+
+
+class UserDirIndex:
+    """Persistent index of phone number -> the user's newest log folder.
+    \nFolders are added with `register` when they are created, so `get` is
+    one indexed SQLite query, which sees the folders registered by every
+    process. The index is built from the log tree with `rebuild`, which
+    `create_app` runs with `build` if it never was, so no request walks the
+    tree.
+    """
+
+    def __init__(self, path: str, chatlog_dir: str) -> None:
+        self.path = path
+        self.chatlog_dir = chatlog_dir
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._built = None
+        self._counters = {"hits": 0, "misses": 0, "registered": 0, "rebuilt": 0}
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS user_dirs "
+                "(number TEXT PRIMARY KEY, path TEXT NOT NULL, created REAL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+            )
+            self._local.conn = conn
+        return conn
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self._counters[key] += 1
+
+    def _path(self, number: str) -> Union[str, None]:
+        row = (
+            self._connection()
+            .execute("SELECT path FROM user_dirs WHERE number = ?", (number,))
+            .fetchone()
+        )
+        return row[0] if row else None
+
+    def register(self, number: str, path: str) -> None:
+        """Record `path` as the newest folder of `number`."""
+        number = number_key(number)
+        path = os.path.normpath(path)
+        # reads don't wait for writers, most messages go to a known folder
+        if self._path(number) == path:
+            return
+        self._connection().execute(
+            "INSERT OR REPLACE INTO user_dirs (number, path, created) VALUES (?, ?, ?)",
+            (number, path, os.path.getctime(path)),
+        )
+        self._count("registered")
+
+    def get(self, number: str) -> Union[str, None]:
+        number = number_key(number)
+        path = self._path(number)
+        if path is None or not os.path.isdir(path):
+            # never registered, or the folder was removed
+            self._count("misses")
+            return None
+        self._count("hits")
+        return path
+
+    def built(self) -> bool:
+        if not self._built:
+            self._built = bool(
+                self._connection()
+                .execute("SELECT 1 FROM meta WHERE key = 'built'")
+                .fetchone()
+            )
+        return self._built
+
+    def build(self) -> int:
+        """Index the log tree if it never was. Returns how many numbers."""
+        return 0 if self.built() else self.rebuild()
+
+    def close(self) -> None:
+        """Close this thread's connection, before forking for example."""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def rebuild(self) -> int:
+        """Index every user folder in the log tree. Returns how many numbers."""
+        newest = {}
+        for number, path, hashed in user_folders(self.chatlog_dir):
+            # a folder already moved to the hashed layout is the current one
+            rank = (hashed, os.path.getctime(path))
+            if number not in newest or rank > newest[number][1]:
+                newest[number] = (path, rank)
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # keep folders registered while the tree was scanned
+            for number, path, created in conn.execute(
+                "SELECT number, path, created FROM user_dirs"
+            ).fetchall():
+                if not os.path.isdir(path):
+                    continue
+                hashed = path == os.path.normpath(hashed_dir(self.chatlog_dir, number))
+                rank = (hashed, created or 0)
+                if number not in newest or rank > newest[number][1]:
+                    newest[number] = (path, rank)
+            conn.execute("DELETE FROM user_dirs")
+            conn.executemany(
+                "INSERT INTO user_dirs (number, path, created) VALUES (?, ?, ?)",
+                [
+                    (number, path, created)
+                    for number, (path, (_, created)) in newest.items()
+                ],
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('built', '1')"
+            )
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        self._built = True
+        self._count("rebuilt")
+        return len(newest)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._counters)
@@ -0,0 +1,154 @@
+# python imports
+import os
+import re
+import abc
+import zlib
+import fcntl
+import threading
+from typing import List, Tuple
+
+# installed imports
+import numpy as np
+
+
+class EmbeddingProvider(abc.ABC):
+    """Turns texts into vectors of `dim` floats."""
+
+    dim = 0
+
+    @abc.abstractmethod
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """One row per text."""
+
+
+class OpenAIEmbeddings(EmbeddingProvider):
+    """Embeddings from the OpenAI API, shortened to `dim` dimensions."""
+
+    def __init__(
+        self, client, model: str = "text-embedding-3-small", dim: int = 256
+    ) -> None:
+        self.client = client
+        self.model = model
+        self.dim = dim
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        response = self.client.embeddings.create(
+            model=self.model,
+            input=texts,
+            # not a keyword argument in this version of the client
+            extra_body={"dimensions": self.dim},
+        )
+        return np.array(
+            [item.embedding for item in sorted(response.data, key=lambda d: d.index)],
+            dtype=np.float32,
+        )
+
+
+class HashingEmbeddings(EmbeddingProvider):
+    """Deterministic bag-of-words vectors (the hashing trick).
+    \nNeeds no network, so it stands in for a real model in tests and
+    benchmarks. Texts sharing words get similar vectors.
+    """
+
+    WORD = re.compile(r"\w+")
+
+    def __init__(self, dim: int = 256) -> None:
+        self.dim = dim
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in self.WORD.findall(text.lower()):
+                h = zlib.crc32(word.encode())
+                vectors[row, h % self.dim] += 1 if h & 1 << 31 else -1
+        return vectors
+
+
+class VectorIndex:
+    """Unit vectors and their ids, appended to two files and searched in memory.
+    \n`{path}.f32` holds the vectors as raw float32 rows and `{path}.ids` the
+    matching int64 ids. Appends only write the new rows, holding an exclusive
+    lock on `{path}.lock` so appends from several processes don't interleave.
+    The files are read again if another process has added to them.
+    """
+
+    def __init__(self, path: str, dim: int) -> None:
+        self.path = path
+        self.dim = dim
+        self._vectors = np.zeros((0, dim), dtype=np.float32)
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._size = 0
+        self._loaded = -1
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._refresh()
+            return self._size
+
+    def _refresh(self) -> None:
+        """Load the rows other processes have appended.
+        This function is meant to be called internally
+        """
+        try:
+            size = os.path.getsize(f"{self.path}.ids") // 8
+        except FileNotFoundError:
+            size = 0
+        if size == self._loaded:
+            return
+        vectors = np.fromfile(f"{self.path}.f32", dtype=np.float32) if size else []
+        ids = np.fromfile(f"{self.path}.ids", dtype=np.int64) if size else []
+        # a row may be half written, use what both files have
+        size = min(len(ids), len(vectors) // self.dim)
+        self._vectors = np.zeros((max(size, 16), self.dim), dtype=np.float32)
+        self._ids = np.zeros(max(size, 16), dtype=np.int64)
+        if size:
+            self._vectors[:size] = np.reshape(
+                vectors[: size * self.dim], (-1, self.dim)
+            )
+            self._ids[:size] = ids[:size]
+        self._size = self._loaded = size
+
+    def add(self, ids: List[int], vectors: np.ndarray) -> None:
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1, norms)
+        ids = np.asarray(ids, dtype=np.int64)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with self._lock, open(f"{self.path}.lock", "a") as lock:
+            # released when the file is closed
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._refresh()
+            with open(f"{self.path}.f32", "ab") as file:
+                vectors.tofile(file)
+            with open(f"{self.path}.ids", "ab") as file:
+                ids.tofile(file)
+            end = self._size + len(ids)
+            if end > len(self._ids):
+                # grow by doubling so appends stay cheap
+                capacity = max(end, 2 * len(self._ids))
+                self._vectors = np.resize(self._vectors, (capacity, self.dim))
+                self._ids = np.resize(self._ids, capacity)
+            self._vectors[self._size : end] = vectors
+            self._ids[self._size : end] = ids
+            self._size = self._loaded = end
+
+    def search(self, vector: np.ndarray, k: int) -> List[Tuple[int, float]]:
+        """The `k` ids most similar to `vector` by cosine similarity, best first."""
+        vector = np.asarray(vector, dtype=np.float32).reshape(self.dim)
+        norm = np.linalg.norm(vector)
+        if not norm:
+            return []
+        with self._lock:
+            self._refresh()
+            vectors = self._vectors[: self._size]
+            ids = self._ids[: self._size]
+        if not len(ids) or k <= 0:
+            return []
+        scores = vectors @ (vector / norm)
+        if k < len(scores):
+            top = np.argpartition(scores, -k)[-k:]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(scores[top])[::-1]]
+        return [(int(ids[i]), float(scores[i])) for i in top]
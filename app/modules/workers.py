@@ -0,0 +1,281 @@
+# python imports
+import time
+import queue
+import threading
+import traceback
+from collections import OrderedDict, deque
+
+# local imports
+from .. import logger
+from .timers import timers
+
+
+class WorkerPool:
+    """Fixed pool of daemon threads draining a bounded job queue.
+
+    Threads are started lazily on the first `submit` so that the pool is
+    created in the gunicorn worker process and not in the master.
+    """
+
+    def __init__(self, name: str, workers: int, maxsize: int = 0) -> None:
+        self.name = name
+        self.workers = workers
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._counters = {"submitted": 0, "completed": 0, "failed": 0, "rejected": 0}
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(
+                    target=self._run, name=f"{self.name}-{i}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self._counters[key] += 1
+
+    def _run(self) -> None:
+        while True:
+            fn, args, kwargs = self._queue.get()
+            try:
+                fn(*args, **kwargs)
+                self._count("completed")
+            except:
+                self._count("failed")
+                logger.error(traceback.format_exc())
+            finally:
+                self._queue.task_done()
+
+    def submit(self, fn, *args, **kwargs) -> bool:
+        """Queue `fn(*args, **kwargs)`. Returns `False` if the queue is full."""
+        self._start()
+        try:
+            self._queue.put_nowait((fn, args, kwargs))
+        except queue.Full:
+            self._count("rejected")
+            return False
+        self._count("submitted")
+        return True
+
+    def depth(self) -> int:
+        """Number of jobs waiting for a free worker."""
+        return self._queue.qsize()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "depth": self.depth(),
+                **self._counters,
+            }
+
+
+class LanePool:
+    """Worker threads running jobs in FIFO lanes.
+    \nJobs submitted under the same key (e.g. a sender's number) run one at a
+    time in submission order. Different lanes run in parallel, up to
+    `workers` at once. A lane goes to the back of the line after each job so
+    a busy lane can't starve the others.
+    """
+
+    def __init__(
+        self, name: str, workers: int, maxsize: int = 0, tracked_lanes: int = 1000
+    ) -> None:
+        self.name = name
+        self.workers = workers
+        self.maxsize = maxsize
+        self.tracked_lanes = tracked_lanes
+        self._lanes = {}  # key -> deque of pending jobs, while scheduled
+        self._ready = queue.Queue()  # keys of lanes waiting for a worker
+        self._pending = 0
+        self._threads = []
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._counters = {"submitted": 0, "completed": 0, "failed": 0, "rejected": 0}
+        # key -> [jobs, total queue time, max queue time]
+        self._waits = OrderedDict()
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(
+                    target=self._run, name=f"{self.name}-{i}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def _record_wait(self, key, wait: float) -> None:
+        waits = self._waits.pop(key, None) or [0, 0.0, 0.0]
+        waits[0] += 1
+        waits[1] += wait
+        waits[2] = max(waits[2], wait)
+        self._waits[key] = waits
+        if len(self._waits) > self.tracked_lanes:
+            self._waits.popitem(last=False)
+
+    def _run(self) -> None:
+        while True:
+            key = self._ready.get()
+            with self._lock:
+                queued_at, fn, args, kwargs = self._lanes[key].popleft()
+                self._pending -= 1
+                self._record_wait(key, time.monotonic() - queued_at)
+            try:
+                fn(*args, **kwargs)
+                outcome = "completed"
+            except:
+                outcome = "failed"
+                logger.error(traceback.format_exc())
+            with self._lock:
+                self._counters[outcome] += 1
+                if self._lanes[key]:
+                    self._ready.put(key)
+                else:
+                    del self._lanes[key]
+                    if not self._lanes:
+                        self._idle.notify_all()
+
+    def submit(self, key, fn, *args, **kwargs) -> bool:
+        """Queue `fn(*args, **kwargs)` at the end of lane `key`.
+        \nReturns `False` if `maxsize` jobs are already waiting, unless lane
+        `key` has jobs waiting or running: the caller would then run this one
+        ahead of them.
+        """
+        return self._submit(key, fn, args, kwargs, force=False)
+
+    def push(self, key, fn, *args, **kwargs) -> None:
+        """Queue like `submit`, past `maxsize` if need be, for jobs that can't
+        be refused.
+        """
+        self._submit(key, fn, args, kwargs, force=True)
+
+    def _submit(self, key, fn, args, kwargs, force: bool) -> bool:
+        self._start()
+        with self._lock:
+            if (
+                not force
+                and self.maxsize
+                and self._pending >= self.maxsize
+                and key not in self._lanes
+            ):
+                self._counters["rejected"] += 1
+                return False
+            job = (time.monotonic(), fn, args, kwargs)
+            lane = self._lanes.get(key)
+            if lane is None:
+                self._lanes[key] = deque([job])
+                self._ready.put(key)
+            else:
+                lane.append(job)
+            self._pending += 1
+            self._counters["submitted"] += 1
+        return True
+
+    def depth(self) -> int:
+        """Number of jobs waiting for a free worker."""
+        return self._pending
+
+    def busy(self, key) -> bool:
+        """Whether lane `key` has jobs waiting or running."""
+        with self._lock:
+            return key in self._lanes
+
+    def join(self, timeout: float = None) -> bool:
+        """Wait until every submitted job has run. Returns `False` on timeout."""
+        with self._idle:
+            return self._idle.wait_for(lambda: not self._lanes, timeout)
+
+    def stats(self) -> dict:
+        with self._lock:
+            jobs = sum(waits[0] for waits in self._waits.values())
+            total_wait = sum(waits[1] for waits in self._waits.values())
+            return {
+                "workers": self.workers,
+                "depth": self._pending,
+                "lanes": len(self._lanes),
+                **self._counters,
+                "wait_avg": round(total_wait / jobs, 3) if jobs else 0,
+                "lane_waits": {
+                    str(key): {
+                        "jobs": waits[0],
+                        "wait_avg": round(waits[1] / waits[0], 3),
+                        "wait_max": round(waits[2], 3),
+                        "queued": len(self._lanes.get(key, ())),
+                    }
+                    for key, waits in self._waits.items()
+                },
+            }
+
+
+class Debouncer:
+    """Collects items per key until the key has been quiet for `window` seconds.
+    \n`flush(key, items, *args)` is then called with everything collected and
+    the `args` of the latest `add`. A burst is flushed after `max_wait`
+    seconds even if items keep arriving. `flush` runs while the debouncer is
+    locked, so flushes for a key never overtake each other; keep it short
+    (e.g. a `submit` to a pool).
+    """
+
+    def __init__(self, window: float, flush, max_wait: float = None) -> None:
+        self.window = window
+        self.max_wait = max_wait or window * 4
+        self._flush = flush
+        self._buffers = {}  # key -> [items, first added at, timer handle, args]
+        self._lock = threading.Lock()
+
+    def add(self, key, items: list, *args, hold: bool = True) -> None:
+        """Collect `items` under `key`. With `hold=False` the key is flushed
+        straight away, together with anything collected before.
+        """
+        with self._lock:
+            buffer = self._buffers.get(key)
+            if buffer:
+                buffer[2].cancel()
+                buffer[0].extend(items)
+                buffer[3] = args
+            else:
+                buffer = [list(items), time.monotonic(), None, args]
+                self._buffers[key] = buffer
+            if not hold or time.monotonic() - buffer[1] >= self.max_wait:
+                self._flush_locked(key)
+                return
+            buffer[2] = timers.call_later(self.window, self.flush, key)
+
+    def _flush_locked(self, key) -> None:
+        buffer = self._buffers.pop(key, None)
+        if not buffer:
+            return
+        if buffer[2]:
+            buffer[2].cancel()
+        try:
+            self._flush(key, buffer[0], *buffer[3])
+        except:
+            logger.error(traceback.format_exc())
+
+    def flush(self, key) -> None:
+        """Flush whatever is collected under `key` now."""
+        with self._lock:
+            self._flush_locked(key)
+
+    def take(self, key) -> list:
+        """Remove and return the items collected under `key` without flushing."""
+        with self._lock:
+            buffer = self._buffers.pop(key, None)
+        if not buffer:
+            return []
+        if buffer[2]:
+            buffer[2].cancel()
+        return buffer[0]
+
+    def pending(self) -> int:
+        """Number of items waiting for their window to close."""
+        with self._lock:
+            return sum(len(buffer[0]) for buffer in self._buffers.values())
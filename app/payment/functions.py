@@ -13,6 +13,7 @@ from dotenv import load_dotenv
 from app import logger
 from app.modules.messages import Messages
 from app.models import User, Transaction
+from app.chatbot.events import WebhookEvent
 
 load_dotenv()
 
@@ -26,7 +27,7 @@ FLW_HEADERS = {
 }
 
 
-def get_account_balance(data: Dict[Any, Any], **kwargs):
+def get_account_balance(data: WebhookEvent, **kwargs):
     """Retrieves user's account balance"""
     from ..modules.functions import log_response, get_user_db
     from ..chatbot.functions import get_number, send_text, get_name
@@ -39,7 +40,7 @@ def get_account_balance(data: Dict[Any, Any], **kwargs):
     try:
         try:
             # get user
-            user = User.query.filter(User.phone_no == number).one_or_none()
+            user = User.by_phone(number)
             if not user:
                 text = "Access to this feature requires an account. Please create an account to proceed."
                 return send_text(text, number)
@@ -82,7 +83,7 @@ def recharge_account(data, **kwargs):
     tokens = kwargs.get("tokens")
     message = kwargs.get("message")
     try:
-        user = User.query.filter(User.phone_no == number).one_or_none()
+        user = User.by_phone(number)
         if not user:
             text = "Access to this feature requires an account. Please create an account to proceed."
             return send_text(text, number)
@@ -92,6 +93,16 @@ def recharge_account(data, **kwargs):
         currency = kwargs.get("currency", "NGN")
         bank_name = kwargs.get("bank_name")
         bank_code = BANK_CODES.get(bank_name)
+        if not bank_code and bank_name:
+            # ChatGPT no longer sees the list, so accept any capitalization
+            bank_name, bank_code = next(
+                (
+                    (name, code)
+                    for name, code in BANK_CODES.items()
+                    if name.lower() == bank_name.strip().lower()
+                ),
+                (bank_name, None),
+            )
         tx_ref = generate_tx_ref("ussd", user.uid)
         if not bank_code:
             bank_list = "\n".join(BANK_CODES.keys())
@@ -0,0 +1,77 @@
+"""Benchmark per-user message databases against the shared one.
+
+Run from the repository root, with the `.env` the app needs:
+
+    python benchmarks/conversation_store.py
+
+Inserts messages for many users, then loads the newest messages of each, the
+way `load_messages` does, with `CONVERSATION_STORE` set to "files" and then
+"sqlite". Also reports how many files each layout leaves on disk.
+"""
+
+import os
+import sys
+import time
+import random
+import tempfile
+
+from sqlalchemy import desc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.modules import messages  # noqa: E402
+
+USERS = 300
+MESSAGES = 20
+CONTEXT = 10
+
+
+def run(store: str, folder: str) -> dict:
+    messages.CONVERSATION_STORE = store
+    messages.CONVERSATION_DB = os.path.join(folder, "conversations.db")
+    messages.engines = messages.EngineCache()
+    paths = []
+    for user in range(USERS):
+        os.makedirs(os.path.join(folder, f"user{user}"))
+        paths.append(os.path.join(folder, f"user{user}", "messages.db"))
+
+    order = [path for path in paths for _ in range(MESSAGES)]
+    random.Random(0).shuffle(order)
+    start = time.perf_counter()
+    for path in order:
+        messages.Messages({"role": "user", "content": "hello " * 20}, path).insert()
+    insert = (time.perf_counter() - start) / len(order)
+
+    start = time.perf_counter()
+    for path in paths:
+        session = messages.get_session(path)
+        rows = (
+            messages.Messages.query_for(session, path)
+            .order_by(desc(messages.Messages.id))
+            .limit(CONTEXT)
+            .all()
+        )
+        assert len(rows) == CONTEXT
+        session.close()
+    load = (time.perf_counter() - start) / len(paths)
+
+    files = sum(
+        name.endswith(".db") for _, _, names in os.walk(folder) for name in names
+    )
+    return {"insert": insert, "load": load, "files": files}
+
+
+def main():
+    print(f"{USERS} users, {MESSAGES} messages each, newest {CONTEXT} loaded")
+    print(f"{'store':<8} {'insert ms':>10} {'load ms':>10} {'db files':>9}")
+    for store in ("files", "sqlite"):
+        with tempfile.TemporaryDirectory() as folder:
+            result = run(store, folder)
+        print(
+            f"{store:<8} {result['insert'] * 1000:>10.3f} "
+            f"{result['load'] * 1000:>10.3f} {result['files']:>9}"
+        )
+
+
+if __name__ == "__main__":
+    main()
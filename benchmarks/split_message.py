@@ -0,0 +1,86 @@
+"""Benchmark the response chunker against the old recursive splitter.
+
+Run from the repository root:
+
+    python benchmarks/split_message.py
+
+The chunker is loaded straight from its file, so no `.env` is needed.
+
+The chunker is about 2-3x slower than the old splitter, though both stay
+well under a millisecond at 100k characters. What it buys is fewer, fuller
+messages: chunks are packed up to the limit instead of halved.
+"""
+
+import os
+import sys
+import time
+import random
+import importlib.util
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+spec = importlib.util.spec_from_file_location(
+    "chunker", os.path.join(ROOT, "app", "modules", "chunker.py")
+)
+chunker = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(chunker)
+
+LIMIT = 4096
+SIZES = (10_000, 25_000, 50_000, 100_000)
+WORDS = "the quick brown *fox* jumps over the lazy dog. is it _really_ lazy?".split()
+
+
+def recursive_split(text: str, max_length: int = LIMIT) -> list:
+    """The splitting done by `meta_split_and_respond` before the chunker."""
+    if len(text) <= max_length:
+        return [text]
+    middle_index = len(text) // 2
+    while middle_index < len(text) and not text[middle_index].isspace():
+        middle_index += 1
+    return recursive_split(text[:middle_index], max_length) + recursive_split(
+        text[middle_index:], max_length
+    )
+
+
+def sample(size: int) -> str:
+    random.seed(size)
+    parts = []
+    length = 0
+    while length < size:
+        if random.random() < 0.04:
+            part = "\n\n"
+        elif random.random() < 0.01:
+            part = "\n```\n" + "print('hello')\n" * random.randint(5, 50) + "```\n"
+        else:
+            part = random.choice(WORDS) + " "
+        parts.append(part)
+        length += len(part)
+    return "".join(parts)
+
+
+def timed(fn, text: str, repeat: int = 20):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        chunks = fn(text, LIMIT)
+        best = min(best, time.perf_counter() - start)
+    return best, chunks
+
+
+def main():
+    print(f"{'chars':>8} {'splitter':>10} {'ms':>8} {'chunks':>7} {'smallest':>9}")
+    for size in SIZES:
+        text = sample(size)
+        for name, fn in (
+            ("recursive", recursive_split),
+            ("chunker", chunker.split_message),
+        ):
+            seconds, chunks = timed(fn, text)
+            assert all(len(chunk) <= LIMIT for chunk in chunks)
+            print(
+                f"{size:>8} {name:>10} {seconds * 1000:>8.3f} {len(chunks):>7} "
+                f"{min(len(chunk) for chunk in chunks):>9}"
+            )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
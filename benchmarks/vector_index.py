@@ -0,0 +1,63 @@
+"""Benchmark top-K search in the per-user vector index.
+
+Run from the repository root:
+
+    python benchmarks/vector_index.py
+
+The index is loaded straight from its file, so no `.env` is needed.
+"""
+
+import os
+import sys
+import time
+import tempfile
+import importlib.util
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+spec = importlib.util.spec_from_file_location(
+    "vectors", os.path.join(ROOT, "app", "modules", "vectors.py")
+)
+vectors = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(vectors)
+
+SIZES = (1_000, 10_000, 50_000)
+DIMS = (128, 256)
+K = 5
+
+
+def timed(fn, repeat: int = 200) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    rng = np.random.default_rng(0)
+    print(
+        f"{'dim':>4} {'messages':>9} {'search ms':>10} {'append ms':>10} "
+        f"{'load ms':>8}"
+    )
+    for dim in DIMS:
+        for size in SIZES:
+            with tempfile.TemporaryDirectory() as folder:
+                path = os.path.join(folder, "memory")
+                index = vectors.VectorIndex(path, dim)
+                index.add(range(size), rng.standard_normal((size, dim)))
+                query = rng.standard_normal(dim)
+                search = timed(lambda: index.search(query, K))
+                ids = iter(range(size, size + 1000))
+                append = timed(lambda: index.add([next(ids)], query), repeat=100)
+                load = timed(lambda: len(vectors.VectorIndex(path, dim)), repeat=10)
+                print(
+                    f"{dim:>4} {size:>9} {search * 1000:>10.3f} "
+                    f"{append * 1000:>10.3f} {load * 1000:>8.2f}"
+                )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -13,6 +13,9 @@ class Config(object):
     LOG_DIR = os.path.join(BASE_DIR, "logs")
     CHATLOG_DIR = os.path.join(LOG_DIR, "chatbot")
     WEBHOOK_LOG = os.path.join(LOG_DIR, "webhooks")
+    QUEUE_DB = os.path.join(LOG_DIR, "queue.db")
+    CONVERSATION_DB = os.path.join(LOG_DIR, "conversations.db")
+    USER_INDEX_DB = os.path.join(LOG_DIR, "user_dirs.db")
     TEMP_FOLDER = os.path.join(BASE_DIR, "tmp")
     FILES = os.path.join(BASE_DIR, "files")
     # key for CSF
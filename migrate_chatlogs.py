@@ -0,0 +1,64 @@
+"""Move user folders from the name-based chat log layout to the hashed one.
+
+With `CHATLOG_LAYOUT=hashed` each user's folder is moved on first use. Run
+this afterwards to move the rest, and to merge the extra folders users got
+when they changed their display name:
+
+    python migrate_chatlogs.py --dry-run
+    python migrate_chatlogs.py
+
+Folders of one number are merged newest first, so the newest message
+database and memory are kept and each day's log keeps its lines in order.
+Stop the app first: lines logged to a folder while it is merged may be lost.
+"""
+
+import os
+import argparse
+from collections import defaultdict
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def main(dry_run: bool = False):
+    from config import Config
+    from app.modules.userdirs import UserDirIndex, hashed_dir, merge_dir, user_folders
+
+    folders = defaultdict(list)
+    for number, path, hashed in user_folders(Config.CHATLOG_DIR):
+        if not hashed:
+            folders[number].append(path)
+    moved = 0
+    for number, paths in folders.items():
+        target = hashed_dir(Config.CHATLOG_DIR, number)
+        # a folder already in the hashed layout is newer than all of these
+        for path in sorted(paths, key=os.path.getctime, reverse=True):
+            print(f"{path} -> {target}")
+            if not dry_run:
+                merge_dir(path, target)
+            moved += 1
+    # remove the emptied AAA..ZZZ and ### folders
+    for group in os.scandir(Config.CHATLOG_DIR):
+        if not dry_run and group.is_dir() and len(group.name) == 3:
+            try:
+                os.rmdir(group.path)
+            except OSError:
+                pass
+    if dry_run:
+        print(f"would move {moved} folders of {len(folders)} numbers")
+        return
+    index = UserDirIndex(Config.USER_INDEX_DB, Config.CHATLOG_DIR)
+    print(f"moved {moved} folders, indexed {index.rebuild()} numbers")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Move chat logs to the hashed folder layout"
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only list the folders that would be moved",
+    )
+    args = parser.parse_args()
+    main(dry_run=args.dry_run)
@@ -0,0 +1,153 @@
+"""Move the per-user messages.db files into the shared conversation database.
+
+Run once before switching the web and worker processes to
+`CONVERSATION_STORE=sqlite`:
+
+    python migrate_conversations.py --dry-run
+    python migrate_conversations.py
+
+Each migrated file is renamed to `messages.db.migrated`, or deleted with
+`--delete`. Running it again only picks up files not migrated yet.
+
+Rows stored under the older `<display_name>_<number>` user keys are moved to
+the number, which the shared database uses since the hashed folder layout.
+"""
+
+import os
+import sqlite3
+import argparse
+from datetime import datetime
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def read(db_path: str):
+    """The messages and summaries of one per-user database."""
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    try:
+        tables = {
+            row[0]
+            for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")
+        }
+        messages = (
+            [dict(row) for row in conn.execute("SELECT * FROM messages ORDER BY id")]
+            if "messages" in tables
+            else []
+        )
+        summaries = (
+            [dict(row) for row in conn.execute("SELECT * FROM summary ORDER BY id")]
+            if "summary" in tables
+            else []
+        )
+    finally:
+        conn.close()
+    return messages, summaries
+
+
+def migrate(db_path: str, session, dry_run: bool = False) -> int:
+    """Copy one per-user database into `session`. Returns the messages copied."""
+    from app.modules.messages import Messages, Summary
+
+    messages, summaries = read(db_path)
+    if dry_run:
+        return len(messages)
+    created_at = datetime.utcfromtimestamp(os.path.getmtime(db_path))
+    # ids change in the shared database, summaries point at the new ones
+    new_ids = {}
+    for row in messages:
+        message = Messages({"role": row["role"], "content": row["content"]}, db_path)
+        message.tokens = row.get("tokens") or message.tokens
+        message.created_at = created_at
+        session.add(message)
+        session.flush()
+        new_ids[row["id"]] = message.id
+    for row in summaries:
+        if row["last_message_id"] not in new_ids:
+            continue
+        summary = Summary(row["content"], new_ids[row["last_message_id"]], db_path)
+        summary.created_at = created_at
+        session.add(summary)
+    return len(messages)
+
+
+def rekey(session, dry_run: bool = False) -> int:
+    """Store rows under the number of their `<display_name>_<number>` user
+    key. Returns how many rows were or would be changed.
+    """
+    from sqlalchemy import func, select, update
+    from app.modules.messages import Messages, Summary
+    from app.modules.userdirs import folder_number
+
+    changed = 0
+    for model in (Messages, Summary):
+        keys = session.execute(
+            select(model.user_key, func.count())
+            .where(model.user_key.like("%\\_%", escape="\\"))
+            .group_by(model.user_key)
+        ).all()
+        for key, count in keys:
+            number = folder_number(key)
+            if not number:
+                continue
+            if not dry_run:
+                session.execute(
+                    update(model).where(model.user_key == key).values(user_key=number)
+                )
+            changed += count
+    if not dry_run:
+        session.commit()
+    return changed
+
+
+def main(delete: bool = False, dry_run: bool = False):
+    from config import Config
+    from app.modules import memory
+    from app.modules.messages import engines, CONVERSATION_DB
+
+    # copies of old messages would all be sent to the embeddings API
+    memory.indexing[0] = False
+    session = engines.get(CONVERSATION_DB)[1]()
+    files = migrated = 0
+    try:
+        for root, _, names in os.walk(Config.CHATLOG_DIR):
+            if "messages.db" not in names:
+                continue
+            db_path = os.path.join(root, "messages.db")
+            count = migrate(db_path, session, dry_run=dry_run)
+            if not dry_run:
+                # one transaction per user, so a failed run can be repeated
+                session.commit()
+                engines.forget(db_path)
+                if delete:
+                    os.remove(db_path)
+                else:
+                    os.rename(db_path, f"{db_path}.migrated")
+            files += 1
+            migrated += count
+            print(f"{db_path}: {count} messages")
+        rekeyed = rekey(session, dry_run=dry_run)
+    finally:
+        session.close()
+    print(f"{'would move' if dry_run else 'moved'} {rekeyed} rows to number keys")
+    action = "would migrate" if dry_run else "migrated"
+    print(f"{action} {migrated} messages from {files} databases to {CONVERSATION_DB}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Move per-user message databases into the shared one"
+    )
+    parser.add_argument(
+        "--delete",
+        action="store_true",
+        help="delete migrated files instead of renaming them",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only count the messages that would be migrated",
+    )
+    args = parser.parse_args()
+    main(delete=args.delete, dry_run=args.dry_run)
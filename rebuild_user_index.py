@@ -0,0 +1,19 @@
+"""Rebuild the phone number -> user folder index from the chat log tree.
+
+The index (`logs/user_dirs.db`) is kept up to date as folders are created and
+built on first use. Rebuild it after moving or renaming folders by hand:
+
+    python rebuild_user_index.py
+"""
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+if __name__ == "__main__":
+    from config import Config
+    from app.modules.userdirs import UserDirIndex
+
+    index = UserDirIndex(Config.USER_INDEX_DB, Config.CHATLOG_DIR)
+    print(f"indexed {index.rebuild()} numbers in {Config.USER_INDEX_DB}")
@@ -0,0 +1,87 @@
+"""braintext-worker: process queued WhatsApp messages.
+
+Requires `CHATBOT_QUEUE=sqlite` on the web processes, which then only store
+incoming messages in the job table. Run with:
+
+    python worker.py --processes 4
+
+Jobs left unacknowledged by a killed worker are picked up again once their
+lease expires.
+"""
+
+import os
+import sys
+import time
+import signal
+import argparse
+import multiprocessing
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def work():
+    from app import create_app, logger
+    from app.chatbot import jobs
+    from app.modules.dispatch import dispatcher
+    from app.modules.functions import transcripts
+
+    stop = multiprocessing.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+
+    if not jobs.store:
+        sys.exit("braintext-worker: CHATBOT_QUEUE=sqlite is required")
+    app = create_app()
+    logger.info(f"WORKER {os.getpid()} STARTED")
+    jobs.drain(app, stop=stop)
+    # deliver replies still queued for sending
+    dispatcher.join(timeout=30)
+    # atexit handlers don't run in multiprocessing children
+    transcripts.flush()
+    logger.info(f"WORKER {os.getpid()} STOPPED")
+
+
+def start(processes: int):
+    if os.getenv("CHATBOT_QUEUE", "memory") != "sqlite":
+        # there would be no job table to process
+        sys.exit("braintext-worker: CHATBOT_QUEUE=sqlite is required")
+    workers = {}
+    running = True
+
+    def shutdown(*_):
+        nonlocal running
+        running = False
+        for process in workers.values():
+            process.terminate()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    while running:
+        # start missing workers and restart dead ones
+        for i in range(processes):
+            process = workers.get(i)
+            if process is None or not process.is_alive():
+                process = multiprocessing.Process(
+                    target=work, name=f"braintext-worker-{i}"
+                )
+                process.start()
+                workers[i] = process
+        time.sleep(1)
+
+    for process in workers.values():
+        process.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="BrainText job worker")
+    parser.add_argument(
+        "-n",
+        "--processes",
+        type=int,
+        default=int(os.getenv("CHATBOT_WORKER_PROCESSES", 2)),
+        help="number of worker processes",
+    )
+    args = parser.parse_args()
+    start(args.processes)